@@ -0,0 +1,551 @@
+#!/usr/bin/env python3
+"""
+Local Benchmark Harness
+Measures provisioning and inventory throughput without touching real machines.
+
+A simulated SSH fleet (an in-process paramiko server listening on one loopback
+address per host) and a synthetic Confluence REST stub are started in child
+processes. semaphore_user_remote_setup.py and get_conf_inbody_inventory.py are
+then driven against them, and throughput, per-host (per-page) latency
+percentiles and peak memory are reported for each scenario.
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import re
+import resource
+import selectors
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+import paramiko
+
+import get_conf_inbody_inventory as inventory
+import instrumentation
+import semaphore_user_remote_setup as setup
+
+BENCH_PASSWORD = "bench"
+BENCH_PUBLIC_KEY = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIBenchBenchBenchBenchBenchBenchBenchBench bench@localhost"
+
+def fleet_addresses(count):
+    """Return count distinct loopback addresses, one per simulated host."""
+    return [f"127.1.{index // 250}.{index % 250 + 1}" for index in range(count)]
+
+def jittered(delay):
+    """Return delay with +/-50% uniform jitter."""
+    return delay * random.uniform(0.5, 1.5) if delay > 0 else 0
+
+class FakeHostState:
+    """Provisioning state of one simulated host, as reported by the probe script."""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.user_exists = False
+        self.password_set = False
+        self.sudoers_content = False
+        self.sudoers_mode = ""
+        self.sudoers_owner = ""
+        self.key_present = False
+    
+    def apply(self, step):
+        """Mark a provisioning step (PROVISION_STEPS name) as applied."""
+        with self.lock:
+            if step == 'create_user':
+                self.user_exists = True
+            elif step == 'set_password':
+                self.password_set = True
+            elif step == 'sudoers':
+                self.sudoers_content = True
+                self.sudoers_mode = "440"
+                self.sudoers_owner = "root:root"
+            elif step == 'authorized_key':
+                self.key_present = True
+    
+    def probe_output(self):
+        with self.lock:
+            return (
+                f"user_exists={int(self.user_exists)}\n"
+                f"password_set={int(self.password_set)}\n"
+                f"sudoers_mode={self.sudoers_mode}\n"
+                f"sudoers_owner={self.sudoers_owner}\n"
+                f"sudoers_content={int(self.sudoers_content)}\n"
+                f"key_present={int(self.key_present)}\n"
+            )
+
+class FakeHostServer(paramiko.ServerInterface):
+    """paramiko server side of one connection to a simulated host.
+    
+    Every host also acts as a bastion and accepts direct-tcpip channels.
+    """
+    
+    def __init__(self, accept_auth):
+        self.accept_auth = accept_auth
+        self.commands = {}
+        self.forwards = {}
+        self.command_ready = threading.Condition()
+    
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+    
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL if self.accept_auth else paramiko.AUTH_FAILED
+    
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL if self.accept_auth else paramiko.AUTH_FAILED
+    
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+    
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.forwards[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+    
+    def check_channel_exec_request(self, channel, command):
+        with self.command_ready:
+            self.commands[channel.get_id()] = command.decode()
+            self.command_ready.notify_all()
+        return True
+    
+    def wait_command(self, channel, timeout=30):
+        with self.command_ready:
+            self.command_ready.wait_for(lambda: channel.get_id() in self.commands, timeout)
+            return self.commands.pop(channel.get_id(), None)
+
+class FakeFleet:
+    """Simulated SSH fleet: one listener per loopback address, one FakeHostState per host.
+    
+    Accepts the commands sent by execute_ssh_command, the SCP upload of the
+    sudoers file and the batched scripts of execute_ssh_script, and injects
+    the configured latency, command failures, slow sudo and auth failures.
+    """
+    
+    def __init__(self, hosts, port, latency=0.0, connect_latency=0.0, sudo_delay=0.0,
+                 failure_rate=0.0, auth_failure_rate=0.0, seed=0):
+        self.hosts = hosts
+        self.port = port
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.sudo_delay = sudo_delay
+        self.failure_rate = failure_rate
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.states = {host: FakeHostState() for host in hosts}
+        # Хосты с отказом аутентификации выбираются детерминированно
+        rng = random.Random(seed)
+        self.auth_failures = {host for host in hosts if rng.random() < auth_failure_rate}
+        self.selector = selectors.DefaultSelector()
+    
+    def listen(self):
+        for host in self.hosts:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((host, self.port))
+            sock.listen(128)
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, host)
+    
+    def serve_forever(self):
+        while True:
+            for key, _ in self.selector.select():
+                try:
+                    conn, _ = key.fileobj.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(True)
+                threading.Thread(target=self.handle_connection, args=(conn, key.data), daemon=True).start()
+    
+    def handle_connection(self, conn, host):
+        time.sleep(jittered(self.connect_latency))
+        transport = paramiko.Transport(conn)
+        transport.add_server_key(self.host_key)
+        server = FakeHostServer(host not in self.auth_failures)
+        try:
+            transport.start_server(server=server)
+        except (paramiko.SSHException, EOFError, OSError):
+            return
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel is None:
+                continue
+            destination = server.forwards.pop(channel.get_id(), None)
+            if destination:
+                threading.Thread(target=self.forward, args=(channel, destination), daemon=True).start()
+            else:
+                threading.Thread(target=self.handle_channel, args=(channel, server, host), daemon=True).start()
+    
+    def forward(self, channel, destination):
+        """Relay a direct-tcpip channel to destination until either side closes."""
+        try:
+            sock = socket.create_connection(destination)
+        except OSError:
+            channel.close()
+            return
+        selector = selectors.DefaultSelector()
+        selector.register(channel, selectors.EVENT_READ, sock)
+        selector.register(sock, selectors.EVENT_READ, channel)
+        try:
+            while True:
+                for key, _ in selector.select():
+                    data = key.fileobj.recv(65536)
+                    if not data:
+                        return
+                    key.data.sendall(data)
+        except (OSError, EOFError):
+            pass
+        finally:
+            selector.close()
+            sock.close()
+            channel.close()
+    
+    def handle_channel(self, channel, server, host):
+        try:
+            command = server.wait_command(channel)
+            if command is None:
+                return
+            time.sleep(jittered(self.latency))
+            if 'sudo' in command:
+                time.sleep(jittered(self.sudo_delay))
+            if random.random() < self.failure_rate:
+                channel.sendall_stderr(b"simulated failure\n")
+                channel.send_exit_status(1)
+            elif command.startswith('scp -t'):
+                self.receive_scp(channel)
+            elif setup.SCRIPT_START_MARKER in command:
+                self.run_script(channel, host)
+            else:
+                self.run_command(channel, command, host)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+    
+    def receive_scp(self, channel):
+        """Accept an SCP sink transfer and discard the data."""
+        stream = channel.makefile('rb')
+        channel.sendall(b"\0")
+        while True:
+            line = stream.readline()
+            if not line:
+                break
+            if line.startswith(b"C"):
+                size = int(line.split()[1])
+                channel.sendall(b"\0")
+                stream.read(size + 1)
+            channel.sendall(b"\0")
+        channel.send_exit_status(0)
+    
+    def run_script(self, channel, host):
+        """Emulate execute_ssh_script: read the streamed script and report every run_step."""
+        stream = channel.makefile('rb')
+        script = stream.read().decode()
+        script = script.split(setup.SCRIPT_START_MARKER + "\n", 1)[-1]
+        state = self.states[host]
+        for step in re.findall(r'^run_step (\w+)$', script, re.MULTILINE):
+            output = state.probe_output() if step == 'probe' else ""
+            state.apply(step)
+            channel.sendall(f"{setup.STEP_BEGIN_MARKER} {step}\n{output}{setup.STEP_END_MARKER} {step} 0\n".encode())
+        channel.send_exit_status(0)
+    
+    def run_command(self, channel, command, host):
+        """Emulate the single commands of the step-by-step provisioning path."""
+        state = self.states[host]
+        if 'adduser' in command:
+            state.apply('create_user')
+        elif 'chpasswd' in command:
+            state.apply('set_password')
+        elif 'chown root:root /etc/sudoers.d/semaphore' in command:
+            state.apply('sudoers')
+        channel.send_exit_status(0)
+
+def serve_fleet(hosts, port, options, ready):
+    """Child process entry point of the simulated SSH fleet."""
+    # Обрывы соединений клиентами - штатная ситуация, не засоряем вывод
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    fleet = FakeFleet(hosts, port, **options)
+    fleet.listen()
+    ready.set()
+    fleet.serve_forever()
+
+def synthetic_pages(count, max_tables, min_rows, max_rows, seed=0):
+    """Build count storage-format pages with tables of varying size; returns {page_id: html}."""
+    rng = random.Random(seed)
+    pages = {}
+    address = 0
+    for index in range(count):
+        parts = ["<h1>Lab hosts</h1><p>Generated by benchmark.py</p>"]
+        for _ in range(rng.randint(1, max_tables)):
+            rows = ["<tr><th>Hostname</th><th>IP</th><th>Role</th><th>Owner</th></tr>"]
+            for _ in range(rng.randint(min_rows, max_rows)):
+                address += 1
+                ip = f"10.{address >> 16 & 255}.{address >> 8 & 255}.{address & 255}"
+                rows.append(f"<tr><td>host-{address}</td><td><p>{ip}</p></td><td>lab</td><td>team-{address % 7}</td></tr>")
+            parts.append(f"<table><tbody>{''.join(rows)}</tbody></table>")
+        pages[str(100000 + index)] = "".join(parts)
+    return pages
+
+def serve_confluence(port, pages, latency, failure_rate, ready):
+    """Child process entry point of the synthetic Confluence REST API stub."""
+    page_ids = list(pages)
+    
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def log_message(self, format, *args):
+            pass
+        
+        def send_json(self, status, data):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def do_GET(self):
+            time.sleep(jittered(latency))
+            if random.random() < failure_rate:
+                self.send_json(503, {'message': 'simulated failure'})
+                return
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == '/rest/api/content/search':
+                start = int(query.get('start', ['0'])[0])
+                limit = int(query.get('limit', ['25'])[0])
+                results = [{'id': page_id} for page_id in page_ids[start:start + limit]]
+                data = {'results': results, 'size': len(results), '_links': {}}
+                if start + limit < len(page_ids):
+                    next_query = urlencode({'cql': query['cql'][0], 'start': start + limit, 'limit': limit})
+                    data['_links']['next'] = f"/rest/api/content/search?{next_query}"
+                self.send_json(200, data)
+                return
+            page_id = url.path.rsplit('/', 1)[-1]
+            if page_id not in pages:
+                self.send_json(404, {'message': 'page not found'})
+                return
+            data = {'id': page_id, 'version': {'number': 1}}
+            if 'body.storage' in query.get('expand', [''])[0]:
+                data['body'] = {'storage': {'value': pages[page_id]}}
+            self.send_json(200, data)
+    
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    ready.set()
+    server.serve_forever()
+
+def start_process(target, *args):
+    """Start a daemon child process and wait until it signals readiness."""
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=target, args=args + (ready,), daemon=True)
+    process.start()
+    if not ready.wait(60):
+        process.terminate()
+        raise RuntimeError(f"{target.__name__} did not start")
+    return process
+
+def measure(name, items, run):
+    """Run run(items) -> [(ok, seconds)] under tracemalloc and return the scenario metrics."""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        timings = run(items)
+    wall = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    
+    durations = [seconds for _, seconds in timings]
+    succeeded = sum(1 for ok, _ in timings if ok)
+    return {
+        'scenario': name,
+        'items': len(timings),
+        'succeeded': succeeded,
+        'failed': len(timings) - succeeded,
+        'wall_seconds': round(wall, 3),
+        'items_per_minute': round(len(timings) * 60 / wall, 1) if wall else 0.0,
+        'p50_ms': round(instrumentation.percentile(durations, 0.50) * 1000, 1),
+        'p95_ms': round(instrumentation.percentile(durations, 0.95) * 1000, 1),
+        'p99_ms': round(instrumentation.percentile(durations, 0.99) * 1000, 1),
+        'peak_heap_mib': round(peak / 2 ** 20, 2),
+        'max_rss_mib': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def timed_map(function, items, workers):
+    """Call function(item) concurrently and return [(ok, seconds)] per item."""
+    def call(item):
+        start = time.perf_counter()
+        try:
+            ok = function(item)
+        except Exception:
+            ok = False
+        return ok, time.perf_counter() - start
+    
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [executor.submit(call, item) for item in items]
+        return [future.result() for future in as_completed(futures)]
+
+def bench_provisioning(hosts, args, extra_options, public_key_file, known_hosts):
+    """Provision every simulated host with setup_host() and time each host."""
+    parser = argparse.ArgumentParser()
+    setup.add_provisioning_arguments(parser)
+    setup_args = parser.parse_args([
+        '--known-hosts', known_hosts,
+        '--semaphore-password', BENCH_PASSWORD,
+        '--ssh-port', str(args.ssh_port),
+        '--workers', str(args.workers),
+        '--public-key', public_key_file,
+        '--no-credential-cache',
+    ] + extra_options)
+    
+    scheduler = setup.ConnectionScheduler.from_args(setup_args)
+    
+    def provision(host):
+        success, _ = setup.setup_host(host, setup_args, BENCH_PASSWORD, scheduler=scheduler)
+        return success
+    try:
+        return timed_map(provision, hosts, args.workers)
+    finally:
+        scheduler.close()
+
+def bench_verification(hosts, args, known_hosts):
+    """Run the --verify key login and sudo check against every simulated host."""
+    parser = argparse.ArgumentParser()
+    setup.add_provisioning_arguments(parser)
+    setup_args = parser.parse_args(['--ssh-port', str(args.ssh_port), '--workers', str(args.workers),
+                                    '--no-credential-cache', '--known-hosts', known_hosts])
+    setup_args.verify_user = 'semaphore'
+    pkey = paramiko.RSAKey.generate(2048)
+    scheduler = setup.ConnectionScheduler.from_args(setup_args)
+    
+    def verify(host):
+        return setup.verify_host(host, setup_args, pkey, scheduler)['status'] == 'pass'
+    try:
+        return timed_map(verify, hosts, args.workers)
+    finally:
+        scheduler.close()
+
+def bench_inventory(page_ids, args):
+    """Fetch and parse every synthetic page the way iter_page_hosts() does, timing each page."""
+    base_url = f"http://127.0.0.1:{args.http_port}"
+    confluence = inventory.ConfluenceClient(base_url, 'bench', BENCH_PASSWORD,
+                                            max_workers=args.fetch_workers, backoff_factor=0.05)
+    listed = confluence.get_space_page_ids('BENCH')
+    if len(listed) != len(page_ids):
+        raise RuntimeError(f"page listing returned {len(listed)} of {len(page_ids)} pages")
+    
+    def fetch(page_id):
+        records, _ = confluence.get_page_hosts(page_id)
+        return records is not None
+    return timed_map(fetch, listed, args.fetch_workers)
+
+def print_report(results):
+    columns = [('scenario', 24), ('items', 6), ('failed', 6), ('wall_seconds', 8), ('items_per_minute', 10),
+               ('p50_ms', 8), ('p95_ms', 8), ('p99_ms', 8), ('peak_heap_mib', 9), ('max_rss_mib', 9)]
+    headers = ['scenario', 'items', 'failed', 'wall s', 'items/min', 'p50 ms', 'p95 ms', 'p99 ms', 'heap MiB', 'RSS MiB']
+    print("  ".join(header.ljust(width) if index == 0 else header.rjust(width)
+                    for index, (header, (_, width)) in enumerate(zip(headers, columns))))
+    for result in results:
+        print("  ".join(str(result[key]).ljust(width) if index == 0 else str(result[key]).rjust(width)
+                        for index, (key, width) in enumerate(columns)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark provisioning and inventory extraction against local simulators')
+    parser.add_argument('--scenario', action='append', choices=['step', 'batch', 'probe', 'jump', 'verify', 'inventory'],
+                        help='Scenario to run, may be repeated (default: all)')
+    parser.add_argument('--hosts', type=int, default=200, help='Number of simulated SSH hosts (default: 200)')
+    parser.add_argument('--workers', type=int, default=20, help='Concurrent provisioning workers (default: 20)')
+    parser.add_argument('--ssh-port', type=int, default=2222, help='Port every simulated host listens on (default: 2222)')
+    parser.add_argument('--latency', type=float, default=0.005, help='Per-command latency of the simulated hosts in seconds (default: 0.005)')
+    parser.add_argument('--connect-latency', type=float, default=0.01, help='Delay before the SSH banner in seconds (default: 0.01)')
+    parser.add_argument('--sudo-delay', type=float, default=0.02, help='Extra delay of commands that use sudo in seconds (default: 0.02)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability that a remote command fails (default: 0)')
+    parser.add_argument('--auth-failure-rate', type=float, default=0.0, help='Fraction of hosts that reject authentication (default: 0)')
+    parser.add_argument('--pages', type=int, default=200, help='Number of synthetic Confluence pages (default: 200)')
+    parser.add_argument('--max-tables', type=int, default=3, help='Maximum tables per page (default: 3)')
+    parser.add_argument('--min-rows', type=int, default=5, help='Minimum rows per table (default: 5)')
+    parser.add_argument('--max-rows', type=int, default=200, help='Maximum rows per table (default: 200)')
+    parser.add_argument('--http-port', type=int, default=18090, help='Port of the Confluence stub (default: 18090)')
+    parser.add_argument('--http-latency', type=float, default=0.01, help='Per-request latency of the Confluence stub in seconds (default: 0.01)')
+    parser.add_argument('--http-failure-rate', type=float, default=0.0, help='Probability of a 503 response from the Confluence stub (default: 0)')
+    parser.add_argument('--fetch-workers', type=int, default=8, help='Concurrent page downloads (default: 8)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data (default: 0)')
+    parser.add_argument('--json', help='Also write the results to this JSON file')
+    args = parser.parse_args()
+    
+    scenarios = args.scenario or ['step', 'batch', 'probe', 'jump', 'verify', 'inventory']
+    processes = []
+    results = []
+    # Симуляторы запускаются в отдельных процессах, чтобы не искажать замеры памяти и GIL
+    multiprocessing.set_start_method('fork')
+    try:
+        ssh_scenarios = [name for name in scenarios if name != 'inventory']
+        if ssh_scenarios:
+            hosts = fleet_addresses(args.hosts)
+            options = {
+                'latency': args.latency,
+                'connect_latency': args.connect_latency,
+                'sudo_delay': args.sudo_delay,
+                'failure_rate': args.failure_rate,
+                'auth_failure_rate': args.auth_failure_rate,
+                'seed': args.seed,
+            }
+            with tempfile.TemporaryDirectory() as work_dir:
+                key_file = os.path.join(work_dir, 'semaphore_id.pub')
+                with open(key_file, 'w') as f:
+                    f.write(BENCH_PUBLIC_KEY + "\n")
+                for name in ssh_scenarios:
+                    # Каждый сценарий начинает с чистого парка хостов
+                    fleet = start_process(serve_fleet, hosts, args.ssh_port, options)
+                    processes.append(fleet)
+                    # Ключи хостов новые в каждом сценарии - кэш тоже свой
+                    known_hosts = os.path.join(work_dir, f"known_hosts_{name}")
+                    if name == 'verify':
+                        print(f"Running key verification against {len(hosts)} simulated hosts...", file=sys.stderr)
+                        results.append(measure("verify", hosts, lambda items: bench_verification(items, args, known_hosts)))
+                        fleet.terminate()
+                        fleet.join()
+                        continue
+                    extra = {
+                        'step': ['--no-probe'],
+                        'batch': ['--no-probe', '--batch'],
+                        'probe': ['--batch'],
+                        # Бастионом служит первый же симулированный хост
+                        'jump': ['--no-probe', '--batch', '--jump-host', f"bench@{hosts[0]}:{args.ssh_port}",
+                                 '--jump-password', BENCH_PASSWORD],
+                    }[name]
+                    print(f"Running {name} provisioning against {len(hosts)} simulated hosts...", file=sys.stderr)
+                    results.append(measure(f"provision-{name}", hosts,
+                                           lambda items: bench_provisioning(items, args, extra, key_file, known_hosts)))
+                    fleet.terminate()
+                    fleet.join()
+        
+        if 'inventory' in scenarios:
+            pages = synthetic_pages(args.pages, args.max_tables, args.min_rows, args.max_rows, args.seed)
+            processes.append(start_process(serve_confluence, args.http_port, pages,
+                                           args.http_latency, args.http_failure_rate))
+            print(f"Running inventory extraction of {len(pages)} synthetic pages...", file=sys.stderr)
+            results.append(measure("inventory", list(pages), lambda items: bench_inventory(items, args)))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+    
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
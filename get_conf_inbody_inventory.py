@@ -1,158 +1,904 @@
-import requests
-import re
-import json
-import argparse
-import getpass
-from typing import List
-
-class ConfluenceClient:
-    def __init__(self, base_url: str, username: str, password: str):
-        self.base_url = base_url.rstrip('/')
-        self.auth = (username, password)
-        self.session = requests.Session()
-        self.session.auth = self.auth
-        
-    def get_page_content(self, page_id: str) -> dict:
-        """Получить содержимое страницы по ID"""
-        url = f"{self.base_url}/rest/api/content/{page_id}?expand=body.storage"
-        
-        try:
-            response = self.session.get(url)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"Ошибка при получении страницы: {e}")
-            raise
-    
-    def extract_table_from_content(self, content: dict) -> str:
-        """Извлечь HTML таблицы из содержимого страницы"""
-        try:
-            storage_content = content['body']['storage']['value']
-            # Ищем таблицу в формате Confluence
-            table_match = re.search(r'<table[^>]*>(.*?)</table>', storage_content, re.DOTALL)
-            if table_match:
-                return table_match.group(0)
-            else:
-                raise ValueError("Таблица не найдена на странице")
-        except KeyError as e:
-            print(f"Ошибка при извлечении таблицы: {e}")
-            raise
-    
-    def extract_ip_addresses(self, table_html: str) -> List[str]:
-        """Извлечь IP-адреса из HTML таблицы"""
-        # Регулярное выражение для поиска IPv4 адресов
-        ip_pattern = r'\b(?:[0-9]{1,3}\.){3}[0-9]{1,3}\b'
-        
-        # Удаляем HTML теги для чистого текста
-        clean_text = re.sub(r'<[^>]+>', ' ', table_html)
-        
-        # Ищем все IP-адреса
-        ip_addresses = re.findall(ip_pattern, clean_text)
-        
-        # Фильтруем валидные IP-адреса
-        valid_ips = []
-        for ip in ip_addresses:
-            if self.is_valid_ip(ip):
-                valid_ips.append(ip)
-        
-        return list(set(valid_ips))  # Убираем дубликаты
-    
-    def is_valid_ip(self, ip: str) -> bool:
-        """Проверить валидность IP-адреса"""
-        parts = ip.split('.')
-        if len(parts) != 4:
-            return False
-        
-        for part in parts:
-            try:
-                num = int(part)
-                if num < 0 or num > 255:
-                    return False
-            except ValueError:
-                return False
-        
-        return True
-    
-    def save_ips_to_file(self, ip_addresses: List[str], filename: str = 'ip_addresses.txt'):
-        """Сохранить IP-адреса в файл"""
-        try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write('[labrat]\n')
-                for ip in ip_addresses:
-                    f.write(ip + '\n')
-            print(f"Найдено {len(ip_addresses)} уникальных IP-адресов. Сохранено в файл: {filename}")
-        except IOError as e:
-            print(f"Ошибка при записи в файл: {e}")
-            raise
-
-def get_password_interactive(prompt: str = "Введите пароль: ") -> str:
-    """Получить пароль интерактивно (без отображения ввода)"""
-    return getpass.getpass(prompt)
-
-def main():
-    parser = argparse.ArgumentParser(
-        description='Извлечение IP-адресов из таблицы Confluence',
-        formatter_class=argparse.RawDescriptionHelpFormatter,
-        epilog='''
-Примеры использования:
-  python script.py --url https://confluence.example.com --username user --page-id 123456
-  python script.py --url https://confluence.example.com --username user --password pass123 --page-id 123456
-  python script.py --url https://confluence.example.com --username user --page-id 123456 --output my_ips.txt
-        '''
-    )
-    
-    # Обязательные аргументы
-    parser.add_argument('--url', required=True, help='URL Confluence (например, https://confluence.example.com)')
-    parser.add_argument('--username', required=True, help='Имя пользователя Confluence')
-    parser.add_argument('--page-id', required=True, help='ID страницы Confluence')
-    
-    # Необязательные аргументы
-    parser.add_argument('--password', help='Пароль (если не указан, запросится интерактивно)')
-    parser.add_argument('--output', default='ip_addresses.txt', help='Имя выходного файла (по умолчанию: ip_addresses.txt)')
-    parser.add_argument('--no-ssl-verify', action='store_true', help='Отключить проверку SSL сертификата')
-    
-    args = parser.parse_args()
-    
-    # Получаем пароль
-    if args.password:
-        password = args.password
-    else:
-        password = get_password_interactive(f"Введите пароль для пользователя {args.username}: ")
-    
-    # Создаем клиент Confluence
-    confluence = ConfluenceClient(args.url, args.username, password)
-    
-    # Опционально отключаем проверку SSL
-    if args.no_ssl_verify:
-        confluence.session.verify = False
-        requests.packages.urllib3.disable_warnings()
-    
-    try:
-        # 1. Получаем содержимое страницы
-        print(f"Получаем содержимое страницы {args.page_id}...")
-        page_content = confluence.get_page_content(args.page_id)
-        
-        # 2. Извлекаем таблицу
-        print("Извлекаем таблицу...")
-        table_html = confluence.extract_table_from_content(page_content)
-        
-        # 3. Извлекаем IP-адреса
-        print("Извлекаем IP-адреса...")
-        ip_addresses = confluence.extract_ip_addresses(table_html)
-        
-        # 4. Сохраняем в файл
-        confluence.save_ips_to_file(ip_addresses, args.output)
-        
-        # Выводим найденные адреса
-        if ip_addresses:
-            print(f"\nНайдено {len(ip_addresses)} уникальных IP-адресов:")
-            for ip in ip_addresses:
-                print(f"  - {ip}")
-        else:
-            print("IP-адреса не найдены в таблице")
-            
-    except Exception as e:
-        print(f"Произошла ошибка: {e}")
-
-if __name__ == "__main__":
-    main()
+#!/usr/bin/env python3
+import requests
+import re
+import json
+import os
+import sys
+import time
+import argparse
+import bisect
+import contextlib
+import getpass
+import ipaddress
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+from typing import Iterator, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import instrumentation
+
+# Регулярное выражение для поиска IPv4 адресов, подсетей (10.1.2.0/26)
+# и диапазонов (10.1.2.10-40 или 10.1.2.10-10.1.2.40)
+IP_PATTERN = re.compile(
+    r'(?<![.\d])\b((?:[0-9]{1,3}\.){3}[0-9]{1,3})'
+    r'(?:/([0-9]{1,2})\b|-((?:[0-9]{1,3}\.){3}[0-9]{1,3}|[0-9]{1,3})\b)?'
+    r'(?!\.?\d)'
+)
+
+# Максимальный размер одной подсети или диапазона, который разворачивается в адреса
+MAX_RANGE_SIZE = 65536
+
+def ip_to_int(ip: str) -> Optional[int]:
+    """Преобразовать IPv4-адрес в целое число; None, если адрес невалиден"""
+    parts = ip.split('.')
+    if len(parts) != 4:
+        return None
+    value = 0
+    for part in parts:
+        if not part.isdigit() or int(part) > 255:
+            return None
+        value = (value << 8) | int(part)
+    return value
+
+def int_to_ip(value: int) -> str:
+    """Преобразовать целое число в IPv4-адрес"""
+    return str(ipaddress.IPv4Address(value))
+
+def parse_ip_range(address: str, prefix: Optional[str] = None, range_end: Optional[str] = None) -> Optional[Tuple[int, int]]:
+    """Преобразовать адрес, подсеть или диапазон в интервал целых чисел [start, end].
+    
+    Подсеть разворачивается, только если указан адрес сети (10.1.2.0/24);
+    адрес хоста с маской (10.1.2.40/24, как в выводе ip addr) - это один хост.
+    Для подсетей /30 и крупнее исключаются адрес сети и широковещательный адрес.
+    Возвращает None для невалидных записей и слишком больших диапазонов.
+    """
+    start = ip_to_int(address)
+    if start is None:
+        return None
+    end = start
+    if prefix is not None:
+        prefix_len = int(prefix)
+        if prefix_len > 32:
+            return None
+        try:
+            network = ipaddress.IPv4Network((start, prefix_len))
+        except ValueError:
+            return start, start
+        start, end = int(network.network_address), int(network.broadcast_address)
+        if prefix_len <= 30:
+            start, end = start + 1, end - 1
+    elif range_end is not None:
+        if '.' in range_end:
+            end = ip_to_int(range_end)
+        elif int(range_end) <= 255:
+            end = (start & 0xFFFFFF00) | int(range_end)
+        else:
+            end = None
+        if end is None or end < start:
+            return None
+    if end - start + 1 > MAX_RANGE_SIZE:
+        spec = f"{address}/{prefix}" if prefix is not None else f"{address}-{range_end}"
+        print(f"Предупреждение: {spec} содержит {end - start + 1} адресов (больше {MAX_RANGE_SIZE}), пропускаем",
+              file=sys.stderr)
+        return None
+    return start, end
+
+def find_ip_ranges(text: str) -> List[Tuple[int, int]]:
+    """Найти в тексте адреса, подсети и диапазоны в виде интервалов [start, end]"""
+    ranges = []
+    for address, prefix, range_end in IP_PATTERN.findall(text):
+        ip_range = parse_ip_range(address, prefix or None, range_end or None)
+        if ip_range is not None:
+            ranges.append(ip_range)
+    return ranges
+
+class IPSet:
+    """Множество IPv4-адресов, хранящееся как отсортированные непересекающиеся интервалы целых чисел.
+    
+    Перекрывающиеся и соседние интервалы сливаются, поэтому подсети и диапазоны
+    занимают память пропорционально числу интервалов, а не адресов. Итерация
+    выдаёт адреса в порядке возрастания.
+    """
+    
+    def __init__(self, ranges=()):
+        self._ranges = []
+        self._dirty = False
+        for start, end in ranges:
+            self.add_range(start, end)
+    
+    @classmethod
+    def from_specs(cls, specs: List[str]) -> 'IPSet':
+        """Построить множество из строк вида 10.0.0.1, 10.0.0.0/24, 10.0.0.1-20"""
+        ip_set = cls()
+        for spec in specs:
+            ranges = find_ip_ranges(spec)
+            if not ranges:
+                raise ValueError(f"Неверный адрес, подсеть или диапазон: {spec}")
+            for start, end in ranges:
+                ip_set.add_range(start, end)
+        return ip_set
+    
+    def add_range(self, start: int, end: int):
+        """Добавить интервал адресов [start, end]"""
+        self._ranges.append((start, end))
+        self._dirty = True
+    
+    def add(self, ip: str):
+        """Добавить один адрес"""
+        value = ip_to_int(ip)
+        if value is None:
+            raise ValueError(f"Неверный IP-адрес: {ip}")
+        self.add_range(value, value)
+    
+    def _merged(self) -> List[Tuple[int, int]]:
+        if self._dirty:
+            merged = []
+            for start, end in sorted(self._ranges):
+                if merged and start <= merged[-1][1] + 1:
+                    if end > merged[-1][1]:
+                        merged[-1] = (merged[-1][0], end)
+                else:
+                    merged.append((start, end))
+            self._ranges = merged
+            self._dirty = False
+        return self._ranges
+    
+    def ranges(self) -> List[Tuple[int, int]]:
+        """Получить слитые интервалы в порядке возрастания"""
+        return list(self._merged())
+    
+    def __contains__(self, ip) -> bool:
+        value = ip_to_int(ip) if isinstance(ip, str) else ip
+        if value is None:
+            return False
+        ranges = self._merged()
+        index = bisect.bisect_right(ranges, (value, 0xFFFFFFFF)) - 1
+        return index >= 0 and ranges[index][0] <= value <= ranges[index][1]
+    
+    def __len__(self) -> int:
+        return sum(end - start + 1 for start, end in self._merged())
+    
+    def __iter__(self) -> Iterator[str]:
+        for start, end in self._merged():
+            for value in range(start, end + 1):
+                yield int_to_ip(value)
+    
+    def clip(self, start: int, end: int) -> List[Tuple[int, int]]:
+        """Получить части интервала [start, end], входящие в множество"""
+        ranges = self._merged()
+        index = max(0, bisect.bisect_right(ranges, (start, 0xFFFFFFFF)) - 1)
+        parts = []
+        while index < len(ranges) and ranges[index][0] <= end:
+            if ranges[index][1] >= start:
+                parts.append((max(start, ranges[index][0]), min(end, ranges[index][1])))
+            index += 1
+        return parts
+    
+    def intersection(self, other: 'IPSet') -> 'IPSet':
+        """Оставить только адреса, входящие в other"""
+        result = IPSet()
+        mine, theirs = self._merged(), other._merged()
+        i = j = 0
+        while i < len(mine) and j < len(theirs):
+            start = max(mine[i][0], theirs[j][0])
+            end = min(mine[i][1], theirs[j][1])
+            if start <= end:
+                result.add_range(start, end)
+            if mine[i][1] < theirs[j][1]:
+                i += 1
+            else:
+                j += 1
+        return result
+    
+    def difference(self, other: 'IPSet') -> 'IPSet':
+        """Исключить адреса, входящие в other"""
+        result = IPSet()
+        theirs = other._merged()
+        j = 0
+        for start, end in self._merged():
+            while j < len(theirs) and theirs[j][1] < start:
+                j += 1
+            k = j
+            while start <= end and k < len(theirs) and theirs[k][0] <= end:
+                if theirs[k][0] > start:
+                    result.add_range(start, theirs[k][0] - 1)
+                start = max(start, theirs[k][1] + 1)
+                k += 1
+            if start <= end:
+                result.add_range(start, end)
+        return result
+
+# Теги, разделяющие текст внутри ячейки
+CELL_TEXT_BREAKS = {'br', 'p', 'div', 'li'}
+
+class TableParser(HTMLParser):
+    """Однопроходный разбор всех таблиц HTML-документа (формат хранения Confluence).
+    
+    Документ можно подавать частями через feed(). Для каждой строки данных в
+    rows сохраняется {'table', 'row', 'headers', 'cells'} - только текст ячеек,
+    без копий исходного HTML. Строка, целиком состоящая из <th>, становится
+    заголовком своей таблицы. Вложенные таблицы разбираются отдельно.
+    """
+    
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.tables = 0
+        self.rows = []
+        self._stack = []
+    
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self._stack.append({'index': self.tables, 'headers': None, 'row_count': 0,
+                                'cells': None, 'cell': None, 'header_row': False})
+            self.tables += 1
+            return
+        if not self._stack:
+            return
+        table = self._stack[-1]
+        if tag == 'tr':
+            if table['cells'] is not None:
+                self._finish_row(table)
+            table['cells'] = []
+            table['header_row'] = True
+        elif tag in ('td', 'th'):
+            if table['cell'] is not None:
+                self._finish_cell(table)
+            if table['cells'] is None:
+                table['cells'] = []
+                table['header_row'] = True
+            table['cell'] = []
+            if tag == 'td':
+                table['header_row'] = False
+        elif tag in CELL_TEXT_BREAKS and table['cell'] is not None:
+            table['cell'].append(' ')
+    
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+    
+    def handle_endtag(self, tag):
+        if not self._stack:
+            return
+        table = self._stack[-1]
+        if tag == 'table':
+            if table['cells'] is not None:
+                self._finish_row(table)
+            self._stack.pop()
+        elif tag in ('td', 'th'):
+            if table['cell'] is not None:
+                self._finish_cell(table)
+        elif tag == 'tr':
+            if table['cells'] is not None:
+                self._finish_row(table)
+        elif tag in CELL_TEXT_BREAKS and table['cell'] is not None:
+            table['cell'].append(' ')
+    
+    def handle_data(self, data):
+        if self._stack and self._stack[-1]['cell'] is not None:
+            self._stack[-1]['cell'].append(data)
+    
+    def _finish_cell(self, table):
+        table['cells'].append(' '.join(''.join(table['cell']).split()))
+        table['cell'] = None
+    
+    def _finish_row(self, table):
+        if table['cell'] is not None:
+            self._finish_cell(table)
+        cells, table['cells'] = table['cells'], None
+        if not cells:
+            return
+        if table['header_row'] and table['headers'] is None:
+            table['headers'] = cells
+            return
+        self.rows.append({'table': table['index'], 'row': table['row_count'],
+                          'headers': table['headers'] or [], 'cells': cells})
+        table['row_count'] += 1
+
+class PageCache:
+    """Локальный кэш страниц Confluence: версия и извлечённые хосты по ID страницы.
+    
+    Запись, проверенная не раньше чем ttl секунд назад, используется без
+    обращения к Confluence; более старая запись сверяется по номеру версии.
+    """
+    
+    # Версия формата записей: при её смене старый кэш игнорируется
+    FORMAT = 4
+    
+    def __init__(self, path: str, ttl: float = 300):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._pages = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            # Записи старого формата просто перечитываются из Confluence
+            if data.get('format') == self.FORMAT:
+                self._pages = data.get('pages', {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"Кэш {self.path} не прочитан, будет создан заново: {e}")
+    
+    def get(self, page_id: str) -> Optional[dict]:
+        """Получить запись кэша для страницы"""
+        with self._lock:
+            return self._pages.get(page_id)
+    
+    def is_fresh(self, entry: dict) -> bool:
+        """Проверить, что запись проверялась в пределах TTL"""
+        return time.time() - entry.get('checked_at', 0) < self.ttl
+    
+    def put(self, page_id: str, version: int, hosts: Optional[List[dict]]):
+        """Сохранить версию страницы и извлечённые из неё хосты (None - таблицы нет)"""
+        with self._lock:
+            self._pages[page_id] = {'version': version, 'hosts': hosts, 'checked_at': time.time()}
+    
+    def touch(self, page_id: str):
+        """Отметить, что версия страницы в кэше подтверждена"""
+        with self._lock:
+            self._pages[page_id]['checked_at'] = time.time()
+    
+    def save(self):
+        """Атомарно записать кэш на диск"""
+        with self._lock:
+            data = json.dumps({'format': self.FORMAT, 'pages': self._pages}, ensure_ascii=False)
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, self.path)
+
+class ConfluenceClient:
+    def __init__(self, base_url: str, username: str, password: str,
+                 max_workers: int = 8, max_retries: int = 5, backoff_factor: float = 1.0):
+        self.base_url = base_url.rstrip('/')
+        self.auth = (username, password)
+        self.max_workers = max(1, max_workers)
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        
+        # Повторы с экспоненциальной задержкой на 429/5xx (с учётом Retry-After)
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+        )
+        # Пул соединений под число параллельных запросов
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=self.max_workers,
+                              pool_maxsize=self.max_workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        # Время, объём и статус каждого запроса - в журнал событий
+        self.session.hooks['response'].append(instrumentation.record_http_response)
+        # Страницы, пропущенные из-за ошибок: {page_id: причина}
+        self.failed_pages = {}
+        
+    def get_page_content(self, page_id: str) -> dict:
+        """Получить содержимое страницы по ID"""
+        url = f"{self.base_url}/rest/api/content/{page_id}?expand=body.storage,version"
+        
+        try:
+            response = self.session.get(url)
+            response.raise_for_status()
+            return response.json()
+        except requests.exceptions.RequestException as e:
+            print(f"Ошибка при получении страницы: {e}")
+            raise
+    
+    def get_page_version(self, page_id: str) -> int:
+        """Получить только номер версии страницы (без тела)"""
+        url = f"{self.base_url}/rest/api/content/{page_id}?expand=version"
+        
+        try:
+            response = self.session.get(url)
+            response.raise_for_status()
+            return response.json()['version']['number']
+        except requests.exceptions.RequestException as e:
+            print(f"Ошибка при получении версии страницы: {e}")
+            raise
+    
+    def get_page_hosts(self, page_id: str, cache: Optional[PageCache] = None) -> Tuple[Optional[List[dict]], str]:
+        """Получить записи о хостах страницы, по возможности из кэша.
+        
+        Возвращает пару (записи или None, источник): 'cache' - запись в пределах TTL,
+        'version' - версия не изменилась, 'download' - тело загружено заново.
+        """
+        entry = cache.get(page_id) if cache else None
+        if entry is not None:
+            if cache.is_fresh(entry):
+                return entry['hosts'], 'cache'
+            if self.get_page_version(page_id) == entry['version']:
+                cache.touch(page_id)
+                return entry['hosts'], 'version'
+        
+        content = self.get_page_content(page_id)
+        records = self.extract_host_records(content)
+        if cache:
+            cache.put(page_id, content.get('version', {}).get('number'), records)
+        return records, 'download'
+    
+    def iter_page_hosts(self, page_ids: List[str], cache: Optional[PageCache] = None) -> Iterator[Tuple[str, Optional[List[dict]], str]]:
+        """Параллельно получить записи о хостах страниц; выдаёт (page_id, записи, источник) по мере готовности.
+        
+        Страница, которую не удалось получить (нет доступа, удалена, кончились
+        повторы), не прерывает сбор: она выдаётся с источником 'error', а
+        причина сохраняется в failed_pages.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self.get_page_hosts, page_id, cache): page_id for page_id in page_ids}
+            for future in as_completed(futures):
+                page_id = futures[future]
+                try:
+                    records, source = future.result()
+                except (requests.exceptions.RequestException, ValueError) as e:
+                    self.failed_pages[page_id] = str(e)
+                    records, source = None, 'error'
+                yield page_id, records, source
+    
+    def iter_paginated(self, url: str, params: dict = None) -> Iterator[dict]:
+        """Перебрать все элементы постраничного ответа REST API, следуя ссылкам _links.next"""
+        while url:
+            try:
+                response = self.session.get(url, params=params)
+                response.raise_for_status()
+                data = response.json()
+            except requests.exceptions.RequestException as e:
+                print(f"Ошибка при получении списка страниц: {e}")
+                raise
+            yield from data.get('results', [])
+            
+            next_link = data.get('_links', {}).get('next')
+            # Ссылка next уже содержит все параметры запроса
+            url = f"{self.base_url}{next_link}" if next_link else None
+            params = None
+    
+    def search_page_ids(self, cql: str, limit: int = 100) -> List[str]:
+        """Получить ID всех страниц, найденных CQL-запросом"""
+        url = f"{self.base_url}/rest/api/content/search"
+        return [page['id'] for page in self.iter_paginated(url, {'cql': cql, 'limit': limit})]
+    
+    def get_descendant_page_ids(self, parent_id: str) -> List[str]:
+        """Получить ID родительской страницы и всех её дочерних страниц (на любой глубине)"""
+        return [parent_id] + self.search_page_ids(f'type = page and ancestor = {parent_id}')
+    
+    def get_space_page_ids(self, space_key: str) -> List[str]:
+        """Получить ID всех страниц пространства"""
+        return self.search_page_ids(f'type = page and space = "{space_key}"')
+    
+    def parse_tables(self, storage_html: str) -> 'TableParser':
+        """Разобрать все таблицы страницы за один проход"""
+        parser = TableParser()
+        parser.feed(storage_html)
+        parser.close()
+        return parser
+    
+    def extract_host_records(self, content: dict) -> Optional[List[dict]]:
+        """Извлечь записи о хостах из всех таблиц страницы; None, если таблиц нет.
+        
+        Каждая запись: {'start', 'end', 'table', 'row', 'column', 'vars'}, где
+        [start, end] - интервал адресов ячейки в виде целых чисел (подсети и
+        диапазоны не разворачиваются), column - заголовок столбца (или его
+        номер), а vars - значения всей строки по заголовкам.
+        """
+        try:
+            storage_content = content['body']['storage']['value']
+        except KeyError as e:
+            print(f"Ошибка при извлечении таблицы: {e}")
+            raise
+        
+        parser = self.parse_tables(storage_content)
+        if not parser.tables:
+            return None
+        
+        records = []
+        for row in parser.rows:
+            headers = row['headers']
+            columns = [headers[i] if i < len(headers) and headers[i] else str(i + 1)
+                       for i in range(len(row['cells']))]
+            row_vars = dict(zip(columns, row['cells']))
+            for column, value in zip(columns, row['cells']):
+                for start, end in find_ip_ranges(value):
+                    records.append({
+                        'start': start,
+                        'end': end,
+                        'table': row['table'],
+                        'row': row['row'],
+                        'column': column,
+                        'vars': row_vars,
+                    })
+        return records
+
+def get_password_interactive(prompt: str = "Введите пароль: ") -> str:
+    """Получить пароль интерактивно (без отображения ввода)"""
+    return getpass.getpass(prompt)
+
+def env_list(name: str) -> List[str]:
+    """Прочитать список значений через запятую из переменной окружения"""
+    return [item.strip() for item in os.environ.get(name, '').split(',') if item.strip()]
+
+def collect_page_ids(confluence: ConfluenceClient, args) -> List[str]:
+    """Собрать ID страниц из всех указанных источников без дубликатов, сохраняя порядок"""
+    page_ids = list(args.page_id)
+    for parent_id in args.parent_id:
+        page_ids.extend(confluence.get_descendant_page_ids(parent_id))
+    for space_key in args.space:
+        page_ids.extend(confluence.get_space_page_ids(space_key))
+    for cql in args.cql:
+        page_ids.extend(confluence.search_page_ids(cql))
+    return list(dict.fromkeys(page_ids))
+
+def collect_hosts(confluence: ConfluenceClient, args, include: Optional[IPSet], exclude: IPSet) -> Tuple[dict, List[str]]:
+    """Собрать записи о хостах со всех страниц.
+    
+    Возвращает пару (записи по ID страницы, отсортированный список IP-адресов
+    после фильтров --include/--exclude).
+    """
+    # 1. Собираем список страниц
+    print("Собираем список страниц...")
+    page_ids = collect_page_ids(confluence, args)
+    print(f"Найдено страниц: {len(page_ids)}")
+    
+    # 2-3. Параллельно загружаем изменившиеся страницы, извлекаем таблицы и IP-адреса
+    print("Загружаем страницы и извлекаем IP-адреса...")
+    cache = None if args.no_cache else PageCache(args.cache_file, args.cache_ttl)
+    sources = {'cache': 'из кэша', 'version': 'версия не изменилась', 'download': 'загружена'}
+    hosts_by_page = {}
+    for page_id, records, source in confluence.iter_page_hosts(page_ids, cache):
+        if source == 'error':
+            print(f"  Страница {page_id}: ошибка загрузки, пропускаем ({confluence.failed_pages[page_id]})")
+            continue
+        if records is None:
+            print(f"  Страница {page_id} ({sources[source]}): таблица не найдена, пропускаем")
+            continue
+        hosts_by_page[page_id] = records
+        print(f"  Страница {page_id} ({sources[source]}): найдено IP-адресов: "
+              f"{sum(record['end'] - record['start'] + 1 for record in records)}")
+    if cache:
+        try:
+            cache.save()
+        except OSError as e:
+            print(f"Не удалось сохранить кэш: {e}")
+    
+    # Объединяем интервалы, убираем дубликаты и применяем фильтры
+    ip_set = IPSet()
+    for records in hosts_by_page.values():
+        for record in records:
+            ip_set.add_range(record['start'], record['end'])
+    if include is not None:
+        ip_set = ip_set.intersection(include)
+    ip_set = ip_set.difference(exclude)
+    # Страницы - в порядке источников, а не в порядке завершения загрузки
+    hosts_by_page = {page_id: hosts_by_page[page_id] for page_id in page_ids if page_id in hosts_by_page}
+    return hosts_by_page, list(ip_set)
+
+def iter_hosts(confluence: ConfluenceClient, args, include: Optional[IPSet], exclude: IPSet) -> Iterator[str]:
+    """Выдавать IP-адреса по мере загрузки страниц, без ожидания остальных.
+    
+    Каждый адрес выдается один раз и только если проходит фильтры
+    --include/--exclude. Порядок - порядок завершения загрузки страниц.
+    """
+    print("Собираем список страниц...")
+    page_ids = collect_page_ids(confluence, args)
+    print(f"Найдено страниц: {len(page_ids)}")
+    
+    cache = None if args.no_cache else PageCache(args.cache_file, args.cache_ttl)
+    seen = set()
+    try:
+        for page_id, records, source in confluence.iter_page_hosts(page_ids, cache):
+            if source == 'error':
+                print(f"  Страница {page_id}: ошибка загрузки, пропускаем ({confluence.failed_pages[page_id]})")
+                continue
+            if records is None:
+                continue
+            for record in records:
+                for value in range(record['start'], record['end'] + 1):
+                    if value in seen or value in exclude or (include is not None and value not in include):
+                        continue
+                    seen.add(value)
+                    yield int_to_ip(value)
+    finally:
+        if cache:
+            try:
+                cache.save()
+            except OSError as e:
+                print(f"Не удалось сохранить кэш: {e}")
+
+def make_var_name(name: str) -> str:
+    """Превратить заголовок столбца в допустимое имя переменной или группы Ansible"""
+    var_name = re.sub(r'\W+', '_', name.strip().lower()).strip('_')
+    if not var_name or var_name[0].isdigit():
+        var_name = f"col_{var_name}"
+    return var_name
+
+def build_inventory(hosts_by_page: dict, ip_addresses: List[str], group: str = 'labrat', group_by: str = 'none') -> dict:
+    """Построить инвентарь в формате JSON динамического инвентаря Ansible.
+    
+    Все хосты попадают в группу group; при group_by='column' или 'page' хосты
+    дополнительно группируются по столбцу таблицы или по странице. Переменные
+    хоста берутся из строки таблицы, где он найден впервые.
+    """
+    # Интервалы записей разворачиваются в адреса только здесь, при выводе
+    allowed = IPSet((value, value) for value in map(ip_to_int, ip_addresses))
+    inventory = {group: {'hosts': list(ip_addresses), 'vars': {}}}
+    hostvars = {}
+    extra_groups = {}
+    for page_id, records in hosts_by_page.items():
+        for record in records:
+            row_vars = None
+            for start, end in allowed.clip(record['start'], record['end']):
+                if row_vars is None:
+                    row_vars = {make_var_name(key): value for key, value in record['vars'].items()}
+                    row_vars['confluence_page_id'] = page_id
+                    row_vars['confluence_column'] = record['column']
+                for value in range(start, end + 1):
+                    ip = int_to_ip(value)
+                    if ip not in hostvars:
+                        hostvars[ip] = dict(row_vars)
+                    if group_by == 'column':
+                        extra_groups.setdefault(make_var_name(record['column']), {})[ip] = None
+                    elif group_by == 'page':
+                        extra_groups.setdefault(f"page_{page_id}", {})[ip] = None
+    
+    for name, hosts in extra_groups.items():
+        if name == group:
+            name = f"{name}_{group_by}"
+        inventory[name] = {'hosts': sorted(hosts, key=ip_to_int), 'vars': {}}
+    inventory['all'] = {'children': list(inventory)}
+    inventory['_meta'] = {'hostvars': {ip: hostvars.get(ip, {}) for ip in ip_addresses}}
+    return inventory
+
+def format_inventory(inventory: dict, fmt: str = 'ini') -> str:
+    """Представить инвентарь в виде INI, JSON или YAML"""
+    if fmt == 'json':
+        return json.dumps(inventory, ensure_ascii=False, indent=2) + '\n'
+    
+    groups = [name for name in inventory if name not in ('all', '_meta')]
+    if fmt == 'yaml':
+        # Переменные хостов указываем один раз - в первой (общей) группе
+        hostvars = inventory['_meta']['hostvars']
+        document = {'all': {'children': {
+            name: {'hosts': {ip: (hostvars.get(ip) or None) if index == 0 else None
+                             for ip in inventory[name]['hosts']}}
+            for index, name in enumerate(groups)
+        }}}
+        try:
+            import yaml
+        except ImportError:
+            # JSON - подмножество YAML, Ansible прочитает его и без PyYAML
+            return json.dumps(document, ensure_ascii=False, indent=2) + '\n'
+        return yaml.safe_dump(document, allow_unicode=True, sort_keys=False)
+    
+    lines = []
+    for name in groups:
+        if lines:
+            lines.append('')
+        lines.append(f"[{name}]")
+        lines.extend(inventory[name]['hosts'])
+    return '\n'.join(lines) + '\n'
+
+def save_inventory(inventory: dict, filename: str, fmt: str = 'ini'):
+    """Сохранить инвентарь в файл"""
+    try:
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(format_inventory(inventory, fmt))
+        print(f"Найдено {len(inventory['_meta']['hostvars'])} уникальных IP-адресов. Сохранено в файл: {filename}")
+    except IOError as e:
+        print(f"Ошибка при записи в файл: {e}")
+        raise
+
+def inventory_cache_key(args) -> str:
+    """Ключ кэша инвентаря: все параметры, влияющие на результат"""
+    return json.dumps([args.url, args.page_id, args.parent_id, args.space, args.cql,
+                       args.include, args.exclude, args.group, args.group_by])
+
+def load_cached_inventory(path: str, key: str, ttl: float) -> Optional[dict]:
+    """Получить инвентарь из кэша, если он построен с теми же параметрами не раньше ttl секунд назад"""
+    try:
+        with open(os.path.expanduser(path), encoding='utf-8') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cached.get('key') != key or time.time() - cached.get('created_at', 0) >= ttl:
+        return None
+    return cached.get('inventory')
+
+def save_cached_inventory(path: str, key: str, inventory: dict):
+    """Атомарно записать инвентарь в кэш"""
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'key': key, 'created_at': time.time(), 'inventory': inventory}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def report_failed_pages(confluence: ConfluenceClient) -> bool:
+    """Перечислить пропущенные из-за ошибок страницы; True, если такие были"""
+    if not confluence.failed_pages:
+        return False
+    print(f"Не удалось получить страниц: {len(confluence.failed_pages)}, их хосты не вошли в результат:")
+    for page_id, error in confluence.failed_pages.items():
+        print(f"  - {page_id}: {error}")
+    return True
+
+def create_client(args, password: str) -> ConfluenceClient:
+    """Создать клиент Confluence по параметрам командной строки"""
+    confluence = ConfluenceClient(args.url, args.username, password,
+                                  max_workers=args.fetch_workers, max_retries=args.max_retries)
+    
+    # Опционально отключаем проверку SSL
+    if args.no_ssl_verify:
+        confluence.session.verify = False
+        requests.packages.urllib3.disable_warnings()
+    return confluence
+
+def run_inventory_mode(args, include: Optional[IPSet], exclude: IPSet):
+    """Ответить на --list или --host в формате динамического инвентаря Ansible.
+    
+    Возвращает False, если часть страниц получить не удалось.
+    """
+    key = inventory_cache_key(args)
+    inventory = None
+    failed = False
+    if args.inventory_cache_ttl > 0:
+        inventory = load_cached_inventory(args.inventory_cache_file, key, args.inventory_cache_ttl)
+    
+    if inventory is None:
+        if not args.password:
+            # Ansible запускает скрипт без терминала - спросить пароль не получится
+            print("Ошибка: укажите пароль через --password или CONFLUENCE_PASSWORD", file=sys.stderr)
+            sys.exit(1)
+        # Весь служебный вывод - в stderr, stdout занят JSON для Ansible
+        with contextlib.redirect_stdout(sys.stderr):
+            try:
+                confluence = create_client(args, args.password)
+                hosts_by_page, ip_addresses = collect_hosts(confluence, args, include, exclude)
+            except Exception as e:
+                print(f"Произошла ошибка: {e}")
+                sys.exit(1)
+            inventory = build_inventory(hosts_by_page, ip_addresses, args.group, args.group_by)
+            failed = report_failed_pages(confluence)
+            # Неполный инвентарь в кэш не попадает
+            if args.inventory_cache_ttl > 0 and not failed:
+                try:
+                    save_cached_inventory(args.inventory_cache_file, key, inventory)
+                except OSError as e:
+                    print(f"Не удалось сохранить кэш инвентаря: {e}")
+    
+    if args.list:
+        print(json.dumps(inventory, ensure_ascii=False))
+    else:
+        print(json.dumps(inventory['_meta']['hostvars'].get(args.host, {}), ensure_ascii=False))
+    return not failed
+
+def add_confluence_arguments(parser, workers_option: str = '--workers'):
+    """Добавить параметры подключения к Confluence, источников страниц и фильтров.
+    
+    workers_option позволяет переименовать параметр числа загрузок, если
+    --workers в скрипте уже занят (см. semaphore_pipeline.py).
+    """
+    # Обязательные аргументы (можно задать через переменные окружения)
+    parser.add_argument('--url', default=os.environ.get('CONFLUENCE_URL'), help='URL Confluence (например, https://confluence.example.com)')
+    parser.add_argument('--username', default=os.environ.get('CONFLUENCE_USERNAME'), help='Имя пользователя Confluence')
+    
+    # Источники страниц (можно комбинировать и повторять, нужен хотя бы один)
+    parser.add_argument('--page-id', action='append', default=env_list('CONFLUENCE_PAGE_ID'), help='ID страницы Confluence')
+    parser.add_argument('--parent-id', action='append', default=env_list('CONFLUENCE_PARENT_ID'), help='ID родительской страницы: обрабатываются она и все дочерние')
+    parser.add_argument('--space', action='append', default=env_list('CONFLUENCE_SPACE'), help='Ключ пространства: обрабатываются все его страницы')
+    parser.add_argument('--cql', action='append', default=[cql for cql in [os.environ.get('CONFLUENCE_CQL')] if cql], help='CQL-запрос для поиска страниц')
+    
+    # Необязательные аргументы
+    parser.add_argument('--password', default=os.environ.get('CONFLUENCE_PASSWORD'), help='Пароль (если не указан, запросится интерактивно)')
+    parser.add_argument('--no-ssl-verify', action='store_true', help='Отключить проверку SSL сертификата')
+    parser.add_argument(workers_option, dest='fetch_workers', type=int, default=8, help='Число параллельных загрузок страниц (по умолчанию: 8)')
+    parser.add_argument('--max-retries', type=int, default=5, help='Число повторов при ответах 429/5xx (по умолчанию: 5)')
+    parser.add_argument('--cache-file', default='~/.cache/ddx-scripts/confluence_pages.json', help='Файл кэша страниц (по умолчанию: ~/.cache/ddx-scripts/confluence_pages.json)')
+    parser.add_argument('--cache-ttl', type=float, default=300, help='Сколько секунд доверять кэшу без проверки версии (по умолчанию: 300)')
+    parser.add_argument('--no-cache', action='store_true', help='Не использовать кэш: всегда загружать страницы целиком')
+    parser.add_argument('--include', action='append', default=[], help='Оставить только адреса из этой подсети или диапазона (можно повторять)')
+    parser.add_argument('--exclude', action='append', default=[], help='Исключить адреса из этой подсети или диапазона (можно повторять)')
+
+def check_confluence_arguments(parser, args) -> Tuple[Optional[IPSet], IPSet]:
+    """Проверить параметры Confluence и вернуть фильтры (include, exclude)"""
+    if not args.url or not args.username:
+        parser.error('укажите --url и --username (или CONFLUENCE_URL и CONFLUENCE_USERNAME)')
+    if not (args.page_id or args.parent_id or args.space or args.cql):
+        parser.error('укажите хотя бы один из параметров --page-id, --parent-id, --space или --cql')
+    
+    try:
+        include = IPSet.from_specs(args.include) if args.include else None
+        exclude = IPSet.from_specs(args.exclude)
+    except ValueError as e:
+        parser.error(str(e))
+    return include, exclude
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Извлечение IP-адресов из таблицы Confluence',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog='''
+Примеры использования:
+  python script.py --url https://confluence.example.com --username user --page-id 123456
+  python script.py --url https://confluence.example.com --username user --password pass123 --page-id 123456
+  python script.py --url https://confluence.example.com --username user --page-id 123456 --output my_ips.txt
+  python script.py --url https://confluence.example.com --username user --parent-id 123456 --space LAB
+  python script.py --url https://confluence.example.com --username user --cql 'label = "inventory"'
+  python script.py --url https://confluence.example.com --username user --page-id 123456 --format yaml --output hosts.yml
+
+Динамический инвентарь Ansible (параметры берутся из переменных окружения
+CONFLUENCE_URL, CONFLUENCE_USERNAME, CONFLUENCE_PASSWORD, CONFLUENCE_PAGE_ID,
+CONFLUENCE_PARENT_ID, CONFLUENCE_SPACE, CONFLUENCE_CQL, CONFLUENCE_GROUP_BY):
+  ansible-inventory -i get_conf_inbody_inventory.py --list
+        '''
+    )
+    
+    add_confluence_arguments(parser)
+    parser.add_argument('--output', default='ip_addresses.txt', help='Имя выходного файла (по умолчанию: ip_addresses.txt)')
+    parser.add_argument('--format', choices=['ini', 'json', 'yaml'], default='ini', help='Формат выходного файла (по умолчанию: ini)')
+    parser.add_argument('--group', default='labrat', help='Группа, в которую попадают все хосты (по умолчанию: labrat)')
+    parser.add_argument('--group-by', choices=['none', 'column', 'page'], default=os.environ.get('CONFLUENCE_GROUP_BY', 'none'), help='Дополнительно сгруппировать хосты по столбцу таблицы или по странице (по умолчанию: none)')
+    
+    # Режим динамического инвентаря Ansible
+    parser.add_argument('--list', action='store_true', help='Вывести весь инвентарь в JSON (динамический инвентарь Ansible)')
+    parser.add_argument('--host', help='Вывести переменные одного хоста в JSON (динамический инвентарь Ansible)')
+    parser.add_argument('--inventory-cache-file', default='~/.cache/ddx-scripts/inventory.json', help='Файл кэша готового инвентаря для --list/--host (по умолчанию: ~/.cache/ddx-scripts/inventory.json)')
+    parser.add_argument('--inventory-cache-ttl', type=float, default=float(os.environ.get('CONFLUENCE_INVENTORY_TTL', 300)), help='Сколько секунд отдавать --list/--host из кэша без обращения к Confluence (по умолчанию: 300, 0 - отключить)')
+    
+    # Замеры времени
+    parser.add_argument('--event-log', help="Дописывать в этот файл JSON-строку о каждом HTTP-запросе ('-' - в stderr)")
+    parser.add_argument('--timing-summary', action='store_true', help='В конце вывести перцентили времени запросов')
+    parser.add_argument('--prometheus-textfile', help='Записать замеры в файл для textfile collector node_exporter')
+    
+    args = parser.parse_args()
+    include, exclude = check_confluence_arguments(parser, args)
+    
+    if args.event_log:
+        try:
+            instrumentation.events.open(args.event_log)
+        except OSError as e:
+            parser.error(f"не удалось открыть журнал событий: {e}")
+    
+    if args.list or args.host is not None:
+        complete = run_inventory_mode(args, include, exclude)
+        # stdout занят JSON для Ansible
+        instrumentation.finish(args.timing_summary, args.prometheus_textfile, 'confluence_inventory', file=sys.stderr)
+        sys.exit(0 if complete else 1)
+    
+    # Получаем пароль
+    if args.password:
+        password = args.password
+    else:
+        password = get_password_interactive(f"Введите пароль для пользователя {args.username}: ")
+    
+    # Создаем клиент Confluence
+    confluence = create_client(args, password)
+    
+    failed = False
+    try:
+        hosts_by_page, ip_addresses = collect_hosts(confluence, args, include, exclude)
+        
+        # 4. Сохраняем в файл
+        inventory = build_inventory(hosts_by_page, ip_addresses, args.group, args.group_by)
+        save_inventory(inventory, args.output, args.format)
+        
+        # Выводим найденные адреса
+        if ip_addresses:
+            print(f"\nНайдено {len(ip_addresses)} уникальных IP-адресов:")
+            for ip in ip_addresses:
+                print(f"  - {ip}")
+        else:
+            print("IP-адреса не найдены в таблице")
+        failed = report_failed_pages(confluence)
+    
+    except Exception as e:
+        print(f"Произошла ошибка: {e}")
+    finally:
+        instrumentation.finish(args.timing_summary, args.prometheus_textfile, 'confluence_inventory')
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Run Instrumentation
+Per-host, per-step timing shared by the provisioning and inventory scripts.
+
+Every timed operation (SSH connect, remote command, SCP, local command,
+Confluence HTTP request) becomes one event with host, stage, step, duration,
+bytes and outcome. Events can be streamed as JSON lines, summarised with
+latency percentiles at the end of a run and exported as a Prometheus
+textfile for the node_exporter textfile collector.
+"""
+
+import contextlib
+import json
+import math
+import os
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+_context = threading.local()
+
+def bind(**fields):
+    """Set host and/or stage for events emitted from the current thread."""
+    for name, value in fields.items():
+        setattr(_context, name, value)
+
+def current(name):
+    return getattr(_context, name, None)
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    # Округление убирает погрешность float: 0.07 * 100 даёт 7.000000000000001
+    index = max(0, min(len(ordered) - 1, math.ceil(round(fraction * len(ordered), 9)) - 1))
+    return ordered[index]
+
+class EventLog:
+    """Thread-safe collector of timing events with an optional JSON-lines sink.
+    
+    Durations are always aggregated per stage/step in memory so a summary can
+    be printed; individual events are only written when a sink is open.
+    """
+    
+    QUANTILES = (0.5, 0.95, 0.99)
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sink = None
+        self.durations = {}
+        self.errors = {}
+        self.bytes = {}
+    
+    def open(self, path):
+        """Stream events to path as JSON lines ('-' for stderr)."""
+        self.sink = sys.stderr if path == '-' else open(path, 'a', encoding='utf-8')
+    
+    def close(self):
+        if self.sink and self.sink is not sys.stderr:
+            self.sink.close()
+        self.sink = None
+    
+    def emit(self, step, duration, host=None, stage=None, nbytes=None, outcome='ok', **fields):
+        """Record one finished operation."""
+        host = host if host is not None else current('host')
+        stage = stage if stage is not None else current('stage')
+        key = (stage or '', step)
+        event = {'ts': round(time.time(), 6), 'host': host, 'stage': stage, 'step': step,
+                 'duration': round(duration, 6), 'bytes': nbytes, 'outcome': outcome}
+        event.update(fields)
+        with self.lock:
+            self.durations.setdefault(key, []).append(duration)
+            self.errors[key] = self.errors.get(key, 0) + (outcome != 'ok')
+            self.bytes[key] = self.bytes.get(key, 0) + (nbytes or 0)
+            if self.sink:
+                self.sink.write(json.dumps(event, ensure_ascii=False) + "\n")
+                self.sink.flush()
+    
+    @contextlib.contextmanager
+    def span(self, step, **fields):
+        """Time the enclosed block as one event.
+        
+        Yields a dict whose 'bytes' and 'outcome' entries the block may set;
+        an exception marks the event as 'error' and is re-raised.
+        """
+        event = {'bytes': None, 'outcome': 'ok'}
+        start = time.perf_counter()
+        try:
+            yield event
+        except BaseException:
+            event['outcome'] = 'error'
+            raise
+        finally:
+            self.emit(step, time.perf_counter() - start, nbytes=event['bytes'],
+                      outcome=event['outcome'], **fields)
+    
+    def summary(self):
+        """Return [{'stage', 'step', 'count', 'errors', 'bytes', 'total', 'p50', 'p95', 'p99'}] sorted by stage/step."""
+        with self.lock:
+            rows = []
+            for (stage, step), durations in sorted(self.durations.items()):
+                row = {'stage': stage, 'step': step, 'count': len(durations),
+                       'errors': self.errors[(stage, step)], 'bytes': self.bytes[(stage, step)],
+                       'total': sum(durations)}
+                for quantile in self.QUANTILES:
+                    row[f"p{int(quantile * 100)}"] = percentile(durations, quantile)
+                rows.append(row)
+            return rows
+    
+    def format_summary(self):
+        rows = self.summary()
+        if not rows:
+            return "No timed operations recorded"
+        lines = [f"{'stage/step':<28} {'count':>6} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'total s':>9}"]
+        for row in rows:
+            name = f"{row['stage']}/{row['step']}" if row['stage'] else row['step']
+            lines.append(f"{name:<28} {row['count']:>6} {row['errors']:>6} {row['p50'] * 1000:>9.1f} "
+                         f"{row['p95'] * 1000:>9.1f} {row['p99'] * 1000:>9.1f} {row['total']:>9.2f}")
+        return "\n".join(lines)
+    
+    def write_prometheus(self, path, prefix):
+        """Atomically write the aggregated timings in Prometheus text exposition format."""
+        metric = f"{prefix}_step_duration_seconds"
+        lines = [
+            f"# HELP {metric} Duration of timed operations per stage and step.",
+            f"# TYPE {metric} summary",
+        ]
+        rows = self.summary()
+        for row in rows:
+            labels = f'stage="{row["stage"]}",step="{row["step"]}"'
+            for quantile in self.QUANTILES:
+                lines.append(f'{metric}{{{labels},quantile="{quantile}"}} {row[f"p{int(quantile * 100)}"]:.6f}')
+            lines.append(f"{metric}_sum{{{labels}}} {row['total']:.6f}")
+            lines.append(f"{metric}_count{{{labels}}} {row['count']}")
+        for name, key, help_text in (("errors_total", 'errors', "Failed timed operations per stage and step."),
+                                     ("bytes_total", 'bytes', "Bytes transferred per stage and step.")):
+            lines.append(f"# HELP {prefix}_step_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_step_{name} counter")
+            for row in rows:
+                lines.append(f'{prefix}_step_{name}{{stage="{row["stage"]}",step="{row["step"]}"}} {row[key]}')
+        lines.append(f"# HELP {prefix}_last_run_timestamp_seconds Unix time the run finished.")
+        lines.append(f"# TYPE {prefix}_last_run_timestamp_seconds gauge")
+        lines.append(f"{prefix}_last_run_timestamp_seconds {time.time():.0f}")
+        
+        # node_exporter может прочитать файл в любой момент - пишем через временный
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+events = EventLog()
+
+def record_http_response(response, *args, **kwargs):
+    """requests response hook: record one Confluence HTTP call."""
+    url = urlparse(response.url)
+    events.emit('http', response.elapsed.total_seconds(), host=url.hostname,
+                stage='search' if url.path.endswith('/search') else 'content',
+                nbytes=len(response.content), outcome='ok' if response.ok else 'failed',
+                status=response.status_code)
+
+def finish(summary=False, prometheus_textfile=None, prefix='ddx', file=None):
+    """End-of-run reporting: print the summary, write the textfile and close the sink."""
+    if summary:
+        print("\n" + events.format_summary(), file=file or sys.stdout, flush=True)
+    if prometheus_textfile:
+        try:
+            events.write_prometheus(prometheus_textfile, prefix)
+        except OSError as e:
+            print(f"Error writing Prometheus textfile: {e}", file=sys.stderr)
+    events.close()
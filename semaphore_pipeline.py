@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Confluence to Semaphore Pipeline
+Reads the host inventory from Confluence and provisions the semaphore user on
+every host in one run. Hosts are streamed: each address is probed (with
+--preflight) and handed to a provisioning worker as soon as its page has been
+parsed, without waiting for the rest of the inventory.
+"""
+
+import argparse
+import sys
+
+import get_conf_inbody_inventory as inventory
+import semaphore_user_remote_setup as setup
+
+def main():
+    parser = argparse.ArgumentParser(description='Provision the semaphore user on every host listed in Confluence')
+    inventory.add_confluence_arguments(parser, workers_option='--fetch-workers')
+    setup.add_provisioning_arguments(parser)
+    
+    args = parser.parse_args()
+    include, exclude = inventory.check_confluence_arguments(parser, args)
+    if not args.semaphore_password:
+        parser.error('the following arguments are required: --semaphore-password')
+    
+    confluence_password = args.password
+    if not confluence_password:
+        confluence_password = inventory.get_password_interactive(f"Confluence password for {args.username}: ")
+    ssh_password, journal = setup.prepare_run(args, "hosts from Confluence")
+    
+    confluence = inventory.create_client(args, confluence_password)
+    hosts = inventory.iter_hosts(confluence, args, include, exclude)
+    try:
+        hosts, results = setup.run_pipeline(hosts, args, ssh_password, journal)
+    except Exception as e:
+        setup.log(f"Error reading inventory from Confluence: {e}")
+        sys.exit(1)
+    finally:
+        setup.finish_run(args, journal)
+    
+    pages_failed = inventory.report_failed_pages(confluence)
+    if not hosts:
+        setup.log("No hosts found in Confluence")
+        sys.exit(1)
+    failed = setup.print_fleet_summary(hosts, results)
+    sys.exit(1 if failed or pages_failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -51,8 +51,9 @@ while IFS= read -r line || [[ -n "$line" ]]; do
     echo "Обработка строки $line_number: '$line_cleaned'"
     
     # Выполняем Python скрипт с аргументом
+    # SSH ключ устанавливается самим Python скриптом через то же SSH соединение,
+    # поэтому copy_key.sh (sshpass/expect) больше не нужен
     /home/anko/repo/ddx-scripts/ddx-env/bin/python3 "$PYTHON_SCRIPT" "$line_cleaned" --ssh-user administrator --ssh-password inbody --semaphore-password "sBrEVAPHV2Ukgy2L"
-    . /home/anko/repo/ddx-scripts/copy_key.sh $line_cleaned sBrEVAPHV2Ukgy2L
     
     echo "--------------------------------"
 done < "$INPUT_FILE"
@@ -1,355 +1,2185 @@
-#!/usr/bin/env python3
-"""
-SSH Remote User Setup Script
-This script automates the process of setting up a semaphore user on a remote host
-with passwordless sudo access and SSH key authentication.
-"""
-
-import argparse
-import sys
-import paramiko
-from scp import SCPClient
-import subprocess
-from pathlib import Path
-
-def execute_ssh_command(ssh_client, command, sudo_password=None, dry_run=False):
-    """Execute a command over SSH and return the result."""
-    if dry_run:
-        print(f"[DRY RUN] Would execute: {command}")
-        return True, "dry-run-simulated-output"
-    
-    try:
-        if sudo_password and command.startswith('sudo '):
-            # For sudo commands, we need to handle password input
-            command = f"echo '{sudo_password}' | sudo -S {command[5:]}"
-        
-        stdin, stdout, stderr = ssh_client.exec_command(command)
-        exit_status = stdout.channel.recv_exit_status()
-        output = stdout.read().decode().strip()
-        error = stderr.read().decode().strip()
-        
-        if exit_status != 0:
-            print(f"Command failed: {command}")
-            print(f"Error: {error}")
-            return False, error
-        return True, output
-    except Exception as e:
-        print(f"Error executing command: {e}")
-        return False, str(e)
-
-def scp_put_file(scp_client, local_file, remote_file, dry_run=False):
-    """Transfer a file via SCP."""
-    if dry_run:
-        print(f"[DRY RUN] Would transfer file: {local_file} -> {remote_file}")
-        return True
-    
-    try:
-        scp_client.put(local_file, remote_file)
-        return True
-    except Exception as e:
-        print(f"Error transferring file via SCP: {e}")
-        return False
-
-def run_local_command(command, dry_run=False):
-    """Execute a local command."""
-    if dry_run:
-        print(f"[DRY RUN] Would execute locally: {command}")
-        return True
-    
-    try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        if result.returncode == 0:
-            return True
-        else:
-            print(f"Local command failed: {command}")
-            print(f"Error: {result.stderr}")
-            return False
-    except Exception as e:
-        print(f"Error executing local command: {e}")
-        return False
-
-def main():
-    parser = argparse.ArgumentParser(description='Setup semaphore user on remote host')
-    parser.add_argument('target_ip', help='Target IP address to connect to')
-    parser.add_argument('--semaphore-password', required=True, help='Password for semaphore user (required)')
-    parser.add_argument('--ssh-user', default='root', help='SSH username (default: root)')
-    parser.add_argument('--ssh-password', help='SSH password (will prompt if not provided)')
-    parser.add_argument('--ssh-key', help='Path to SSH private key')
-    parser.add_argument('--ssh-port', type=int, default=22, help='SSH port (default: 22)')
-    parser.add_argument('--dry-run', action='store_true', help='Show what would be done without making any changes')
-    
-    args = parser.parse_args()
-    
-    if args.dry_run:
-        print("=== DRY RUN MODE ===")
-        print("No changes will be made to the remote system or local system.")
-        print("=" * 50)
-    
-    # Get SSH password if not provided
-    ssh_password = args.ssh_password
-    if not ssh_password and not args.ssh_key and not args.dry_run:
-        import getpass
-        ssh_password = getpass.getpass(f"Enter SSH password for {args.ssh_user}@{args.target_ip}: ")
-    
-    # SSH client setup
-    ssh_client = None
-    
-    try:
-        if not args.dry_run:
-            print(f"Connecting to {args.target_ip}...")
-            ssh_client = paramiko.SSHClient()
-            ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            
-            # Connect to remote host
-            if args.ssh_key:
-                ssh_client.connect(
-                    hostname=args.target_ip,
-                    username=args.ssh_user,
-                    key_filename=args.ssh_key,
-                    port=args.ssh_port
-                )
-            else:
-                ssh_client.connect(
-                    hostname=args.target_ip,
-                    username=args.ssh_user,
-                    password=ssh_password,
-                    port=args.ssh_port
-                )
-            print("Connected successfully!")
-        else:
-            print(f"[DRY RUN] Would connect to {args.target_ip} as {args.ssh_user}")
-            if args.ssh_key:
-                print(f"[DRY RUN] Using SSH key: {args.ssh_key}")
-            else:
-                print("[DRY RUN] Using password authentication")
-        
-        # Step 2: Create semaphore user with password
-        print("\n1. Creating semaphore user...")
-        if args.dry_run:
-            print(f"[DRY RUN] Would create user 'semaphore' with password")
-            # Simulate user creation commands
-            success, output = execute_ssh_command(
-                ssh_client, 
-                f"sudo adduser --gecos '' --disabled-password semaphore", 
-                ssh_password, 
-                args.dry_run
-            )
-            success, output = execute_ssh_command(
-                ssh_client,
-                f"echo 'semaphore:{args.semaphore_password}' | sudo chpasswd",
-                ssh_password,
-                args.dry_run
-            )
-        else:
-            # Create user without password initially
-            success, output = execute_ssh_command(
-                ssh_client, 
-                "sudo adduser --gecos '' --disabled-password semaphore", 
-                ssh_password, 
-                args.dry_run
-            )
-            if not success:
-                print("Failed to create semaphore user")
-                sys.exit(1)
-            
-            # Set password for the user - используем правильную команду с sudo -S
-            # Экранируем пароль для безопасной передачи
-            escaped_password = args.semaphore_password.replace("'", "'\"'\"'")
-            chpasswd_command = f"echo 'semaphore:{escaped_password}' | sudo -S chpasswd"
-            
-            success, output = execute_ssh_command(
-                ssh_client,
-                chpasswd_command,
-                ssh_password,
-                args.dry_run
-            )
-            if not success:
-                print("Failed to set password for semaphore user")
-                # Попробуем альтернативный метод
-                print("Trying alternative method to set password...")
-                
-                # Альтернативный метод: используем sudo с опцией -S для chpasswd
-                alternative_command = f"echo '{ssh_password}' | sudo -S sh -c \"echo 'semaphore:{escaped_password}' | chpasswd\""
-                success, output = execute_ssh_command(
-                    ssh_client,
-                    alternative_command,
-                    None,  # Пароль уже в команде
-                    args.dry_run
-                )
-                
-                if not success:
-                    print("Alternative method also failed")
-                    sys.exit(1)
-        
-        print("✓ Semaphore user created successfully with specified password")
-        
-        # Step 3 & 4: Create sudoers file
-        print("\n2. Creating sudoers file...")
-        sudoers_content = "semaphore ALL=(ALL) NOPASSWD: ALL\n"
-        
-        if args.dry_run:
-            print(f"[DRY RUN] Would create file /etc/sudoers.d/semaphore with content:")
-            print(f"[DRY RUN] '{sudoers_content.strip()}'")
-        else:
-            # Create temporary file using pathlib
-            temp_file = Path("/tmp/semaphore_sudoers")
-            try:
-                temp_file.write_text(sudoers_content)
-            except Exception as e:
-                print(f"Error creating temporary file: {e}")
-                sys.exit(1)
-            
-            # Use SCP to transfer the file
-            try:
-                scp = SCPClient(ssh_client.get_transport())
-                transfer_success = scp_put_file(scp, str(temp_file), '/tmp/semaphore_sudoers', args.dry_run)
-                scp.close()
-                
-                if transfer_success:
-                    # Move file to correct location
-                    success, output = execute_ssh_command(
-                        ssh_client, 
-                        "sudo mv /tmp/semaphore_sudoers /etc/sudoers.d/semaphore",
-                        ssh_password,
-                        args.dry_run
-                    )
-                    if not success:
-                        print("Failed to move sudoers file")
-                        sys.exit(1)
-                else:
-                    # Alternative method using echo
-                    success, output = execute_ssh_command(
-                        ssh_client, 
-                        f"echo 'semaphore ALL=(ALL) NOPASSWD: ALL' | sudo tee /etc/sudoers.d/semaphore",
-                        ssh_password,
-                        args.dry_run
-                    )
-                    if not success:
-                        print("Failed to create sudoers file")
-                        sys.exit(1)
-            except Exception as e:
-                print(f"Error during file transfer: {e}")
-                sys.exit(1)
-            
-            # Clean up local temp file using pathlib
-            if temp_file.exists():
-                temp_file.unlink()
-        
-        print("✓ Sudoers file created successfully")
-        
-        # Step 5: Set correct permissions
-        print("\n3. Setting file permissions...")
-        success, output = execute_ssh_command(ssh_client, "sudo chmod 440 /etc/sudoers.d/semaphore", 
-                                            ssh_password, args.dry_run)
-        if not success and not args.dry_run:
-            print("Failed to set permissions")
-            sys.exit(1)
-
-        print("\n4. Setting file owner...")
-        success, output = execute_ssh_command(ssh_client, "sudo chown root:root /etc/sudoers.d/semaphore", 
-                                            ssh_password, args.dry_run)
-        if not success and not args.dry_run:
-            print("Failed to set owner")
-            sys.exit(1)
-        print("✓ Permissions set successfully")
-        
-        # Step 6: Close SSH connection
-        if ssh_client and not args.dry_run:
-            ssh_client.close()
-            print("\n5. SSH connection closed")
-        elif args.dry_run:
-            print("[DRY RUN] Would close SSH connection")
-        
-        # Step 7: Copy SSH key to semaphore user
-        print("\n6. Copying SSH key to semaphore user...")
-        ssh_key_path = Path("/home/anko/id_ed25519.pub")
-        
-        if args.dry_run:
-            print(f"[DRY RUN] Would check for SSH key at: {ssh_key_path}")
-            print(f"[DRY RUN] Would execute: sudo ssh-copy-id -i {ssh_key_path} semaphore@{args.target_ip}")
-        else:
-            # Используем pathlib для проверки существования файла
-            if not ssh_key_path.exists():
-                print(f"Warning: SSH key not found at {ssh_key_path}")
-                print("Please generate SSH key first with: ssh-keygen -t ed25519 -f /home/semaphore/.ssh/id_ed25519")
-                print("Or copy the key manually using password authentication.")
-            else:
-                try:
-                    # Use sshpass to provide password for ssh-copy-id
-                    result = subprocess.run([
-                        'sshpass', '-p', args.semaphore_password,
-                        'ssh-copy-id', '-i', str(ssh_key_path), 
-                        '-o', 'StrictHostKeyChecking=no',
-                        f'semaphore@{args.target_ip}'
-                    ], capture_output=True, text=True)
-                    
-                    if result.returncode == 0:
-                        print("✓ SSH key copied successfully!")
-                    else:
-                        print(f"Failed to copy SSH key: {result.stderr}")
-                        print("You may need to install sshpass or copy the key manually")
-                        print(f"Manual command: cat {ssh_key_path} | ssh semaphore@{args.target_ip} 'mkdir -p ~/.ssh && cat >> ~/.ssh/authorized_keys'")
-                except FileNotFoundError:
-                    print("sshpass not found. Trying without password automation...")
-                    # Alternative manual approach
-                    try:
-                        # Read the public key
-                        public_key = ssh_key_path.read_text().strip()
-                        # Use SSH to add the key manually
-                        temp_ssh = paramiko.SSHClient()
-                        temp_ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-                        temp_ssh.connect(
-                            hostname=args.target_ip,
-                            username='semaphore',
-                            password=args.semaphore_password
-                        )
-                        
-                        # Ensure .ssh directory exists and add key
-                        commands = [
-                            'mkdir -p ~/.ssh',
-                            f'echo "{public_key}" >> ~/.ssh/authorized_keys',
-                            'chmod 700 ~/.ssh',
-                            'chmod 600 ~/.ssh/authorized_keys'
-                        ]
-                        
-                        for cmd in commands:
-                            stdin, stdout, stderr = temp_ssh.exec_command(cmd)
-                            exit_status = stdout.channel.recv_exit_status()
-                            if exit_status != 0:
-                                print(f"Failed to execute: {cmd}")
-                                break
-                        else:
-                            print("✓ SSH key configured successfully!")
-                        
-                        temp_ssh.close()
-                        
-                    except Exception as e:
-                        print(f"Error configuring SSH key: {e}")
-                        print("Please configure SSH key manually")
-        
-        print("\n" + "=" * 50)
-        if args.dry_run:
-            print("DRY RUN COMPLETED SUCCESSFULLY!")
-            print("No changes were made to the system.")
-        else:
-            print("SETUP COMPLETED SUCCESSFULLY!")
-            print(f"You can now SSH to the remote host as semaphore user:")
-            print(f"  ssh semaphore@{args.target_ip}")
-            print(f"Password: {args.semaphore_password}")
-        
-    except paramiko.AuthenticationException:
-        print("Authentication failed. Please check your credentials.")
-        sys.exit(1)
-    except paramiko.SSHException as e:
-        print(f"SSH connection failed: {e}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"Unexpected error: {e}")
-        sys.exit(1)
-    finally:
-        # Ensure SSH connection is closed
-        if ssh_client and not args.dry_run:
-            ssh_client.close()
-
-if __name__ == "__main__":
-    main()
+#!/usr/bin/env python3
+"""
+SSH Remote User Setup Script
+This script automates the process of setting up a semaphore user on a remote host
+with passwordless sudo access and SSH key authentication.
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import hashlib
+import ipaddress
+import itertools
+import json
+import os
+import random
+import signal
+import socket
+import sys
+import threading
+import time
+import weakref
+import paramiko
+from scp import SCPClient
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instrumentation
+
+_log_context = threading.local()
+_log_lock = threading.Lock()
+
+# Клиенты, для которых пароль sudo уже проверен
+_sudo_validated = weakref.WeakKeyDictionary()
+
+SUDOERS_CONTENT = "semaphore ALL=(ALL) NOPASSWD: ALL\n"
+SUDOERS_FILE = "/etc/sudoers.d/semaphore"
+
+PROVISION_STEPS = ('create_user', 'set_password', 'sudoers', 'authorized_key')
+
+# Маркеры, по которым разбирается вывод пакетного скрипта на шаги
+STEP_BEGIN_MARKER = "__DDX_STEP_BEGIN__"
+STEP_END_MARKER = "__DDX_STEP_END__"
+SCRIPT_START_MARKER = "__DDX_SCRIPT__"
+HEREDOC_DELIMITER = "__DDX_EOF__"
+
+def log(message=""):
+    """Print a message, prefixed with the current host when running in fleet mode.
+    
+    A daemon job thread sets a sink instead, which receives the message.
+    """
+    prefix = getattr(_log_context, 'prefix', None)
+    if prefix:
+        # Пустые строки-разделители в параллельном выводе только мешают
+        lines = [line for line in str(message).split("\n") if line.strip()]
+        if not lines:
+            return
+        message = "\n".join(f"[{prefix}] {line}" for line in lines)
+    sink = getattr(_log_context, 'sink', None)
+    if sink:
+        sink(str(message))
+        return
+    # Одна запись под блокировкой, чтобы строки воркеров не перемешивались
+    with _log_lock:
+        sys.stdout.write(f"{message}\n")
+        sys.stdout.flush()
+
+def execute_ssh_command(ssh_client, command, sudo_password=None, dry_run=False):
+    """Execute a command over SSH and return the result."""
+    if dry_run:
+        log(f"[DRY RUN] Would execute: {command}")
+        return True, "dry-run-simulated-output"
+    
+    with instrumentation.events.span('exec') as event:
+        try:
+            if sudo_password and command.startswith('sudo '):
+                # For sudo commands, we need to handle password input
+                command = f"echo '{sudo_password}' | sudo -S {command[5:]}"
+            
+            stdin, stdout, stderr = ssh_client.exec_command(command)
+            exit_status = stdout.channel.recv_exit_status()
+            output = stdout.read().decode().strip()
+            error = stderr.read().decode().strip()
+            event['bytes'] = len(output) + len(error)
+            
+            if exit_status != 0:
+                event['outcome'] = 'failed'
+                log(f"Command failed: {command}")
+                log(f"Error: {error}")
+                return False, error
+            return True, output
+        except Exception as e:
+            event['outcome'] = 'error'
+            log(f"Error executing command: {e}")
+            return False, str(e)
+
+def scp_put_file(scp_client, local_file, remote_file, dry_run=False):
+    """Transfer a file via SCP."""
+    if dry_run:
+        log(f"[DRY RUN] Would transfer file: {local_file} -> {remote_file}")
+        return True
+    
+    with instrumentation.events.span('scp') as event:
+        try:
+            scp_client.put(local_file, remote_file)
+            event['bytes'] = os.path.getsize(local_file)
+            return True
+        except Exception as e:
+            event['outcome'] = 'error'
+            log(f"Error transferring file via SCP: {e}")
+            return False
+
+def run_local_command(command, dry_run=False):
+    """Execute a local command."""
+    if dry_run:
+        log(f"[DRY RUN] Would execute locally: {command}")
+        return True
+    
+    with instrumentation.events.span('local') as event:
+        try:
+            result = subprocess.run(command, shell=True, capture_output=True, text=True)
+            event['bytes'] = len(result.stdout) + len(result.stderr)
+            if result.returncode == 0:
+                return True
+            else:
+                event['outcome'] = 'failed'
+                log(f"Local command failed: {command}")
+                log(f"Error: {result.stderr}")
+                return False
+        except Exception as e:
+            event['outcome'] = 'error'
+            log(f"Error executing local command: {e}")
+            return False
+
+def authorized_key_step(public_key):
+    """Return the (name, body) script step that appends public_key to ~semaphore/.ssh/authorized_keys."""
+    return ("authorized_key",
+        f"key=$(cat <<'{HEREDOC_DELIMITER}'\n"
+        f"{public_key.strip()}\n"
+        f"{HEREDOC_DELIMITER}\n"
+        ")\n"
+        "home=$(getent passwd semaphore | cut -d: -f6)\n"
+        "[ -n \"$home\" ] || { echo \"home directory of semaphore not found\"; return 1; }\n"
+        "mkdir -p \"$home/.ssh\" && touch \"$home/.ssh/authorized_keys\" || return 1\n"
+        "grep -qxF \"$key\" \"$home/.ssh/authorized_keys\" || printf '%s\\n' \"$key\" >> \"$home/.ssh/authorized_keys\" || return 1\n"
+        "chown -R semaphore: \"$home/.ssh\" && chmod 700 \"$home/.ssh\" && chmod 600 \"$home/.ssh/authorized_keys\"")
+
+def provision_steps(semaphore_password, sudoers_content=SUDOERS_CONTENT, public_key=None, only=None):
+    """Return the idempotent (name, body) script steps that provision the semaphore user.
+    
+    If only is given, steps whose names are not in it are left out.
+    """
+    sudoers_content = sudoers_content.rstrip("\n")
+    steps = []
+    
+    steps.append(("create_user",
+        "id -u semaphore >/dev/null 2>&1 || adduser --gecos '' --disabled-password semaphore"))
+    
+    steps.append(("set_password",
+        f"chpasswd <<'{HEREDOC_DELIMITER}'\n"
+        f"semaphore:{semaphore_password}\n"
+        f"{HEREDOC_DELIMITER}"))
+    
+    steps.append(("sudoers",
+        "tmp=$(mktemp) || return 1\n"
+        f"cat > \"$tmp\" <<'{HEREDOC_DELIMITER}'\n"
+        f"{sudoers_content}\n"
+        f"{HEREDOC_DELIMITER}\n"
+        "if command -v visudo >/dev/null 2>&1 && ! visudo -cf \"$tmp\" >/dev/null; then\n"
+        "    echo \"sudoers syntax check failed\"; rm -f \"$tmp\"; return 1\n"
+        "fi\n"
+        "install -m 440 -o root -g root \"$tmp\" /etc/sudoers.d/semaphore\n"
+        "rc=$?; rm -f \"$tmp\"; return $rc"))
+    
+    if public_key:
+        steps.append(authorized_key_step(public_key))
+    if only is not None:
+        steps = [step for step in steps if step[0] in only]
+    return steps
+
+def build_script(steps):
+    """Assemble (name, body) steps into a script that reports each step's exit status.
+    
+    Secrets are embedded via quoted here-documents, so the script is meant to
+    be streamed over stdin and never placed on a command line.
+    """
+    lines = [
+        "run_step() {",
+        f"    echo \"{STEP_BEGIN_MARKER} $1\"",
+        "    \"step_$1\" 2>&1",
+        "    rc=$?",
+        f"    echo \"{STEP_END_MARKER} $1 $rc\"",
+        "    [ $rc -eq 0 ] || exit $rc",
+        "}",
+    ]
+    for name, body in steps:
+        # Тело не отступаем: иначе ломаются here-documents
+        lines.append(f"step_{name}() {{")
+        lines.append(body)
+        lines.append("}")
+    for name, _ in steps:
+        lines.append(f"run_step {name}")
+    return "\n".join(lines) + "\n"
+
+def parse_script_steps(output):
+    """Split batched script output into a list of {'step', 'exit_status', 'output'} dicts."""
+    steps = []
+    current = None
+    for line in output.splitlines():
+        if line.startswith(STEP_BEGIN_MARKER + " "):
+            current = {'step': line.split()[1], 'exit_status': None, 'output': []}
+        elif line.startswith(STEP_END_MARKER + " ") and current is not None:
+            current['exit_status'] = int(line.split()[2])
+            current['output'] = "\n".join(current['output']).strip()
+            steps.append(current)
+            current = None
+        elif current is not None:
+            current['output'].append(line)
+    if current is not None:
+        # Шаг начался, но скрипт оборвался до его завершения
+        current['output'] = "\n".join(current['output']).strip()
+        steps.append(current)
+    return steps
+
+def validate_sudo(ssh_client, sudo_password):
+    """Check sudo_password with exactly one sudo attempt on a channel of its own.
+    
+    The channel's stdin holds nothing but the password, so a wrong one cannot
+    be followed by further guesses. A success is remembered per client.
+    Returns (success, error).
+    """
+    if _sudo_validated.get(ssh_client) == sudo_password:
+        return True, ""
+    with instrumentation.events.span('sudo') as event:
+        try:
+            stdin, stdout, stderr = ssh_client.exec_command("sudo -S -p '' -v")
+            try:
+                stdin.write(f"{sudo_password}\n")
+                stdin.flush()
+                stdin.channel.shutdown_write()
+            except OSError:
+                # Без запроса пароля (NOPASSWD) sudo завершается, не читая stdin
+                pass
+            exit_status = stdout.channel.recv_exit_status()
+            error = stderr.read().decode().strip()
+        except Exception as e:
+            event['outcome'] = 'error'
+            return False, str(e)
+        if exit_status != 0:
+            event['outcome'] = 'failed'
+            log(f"sudo rejected the password: {error}")
+            return False, error or "sudo password rejected"
+    _sudo_validated[ssh_client] = sudo_password
+    return True, ""
+
+def execute_ssh_script(ssh_client, script, sudo_password=None, dry_run=False):
+    """Run a whole script as root over a single SSH channel.
+    
+    The sudo password and the script are streamed over stdin, so secrets
+    never appear on the remote command line; the password is checked by
+    validate_sudo() first so sudo makes a single attempt. Returns (success, steps), where
+    steps is the output of parse_script_steps().
+    """
+    if dry_run:
+        log("[DRY RUN] Would execute batched script over a single channel:")
+        for line in script.splitlines():
+            if line.startswith("run_step "):
+                log(f"[DRY RUN]   {line[len('run_step '):]}")
+        return True, []
+    
+    if sudo_password:
+        # Неверный пароль sudo прочитал бы следующими строками stdin - маркер и
+        # сам скрипт - как новые попытки, поэтому пароль проверяется заранее
+        success, error = validate_sudo(ssh_client, sudo_password)
+        if not success:
+            return False, [{'step': 'sudo', 'exit_status': None, 'output': error}]
+    
+    # sudo -S читает пароль только если он нужен, поэтому строки до маркера
+    # пропускаются в любом случае, а остаток stdin исполняет bash; без пароля
+    # sudo -n не делает ни одной попытки
+    command = (
+        f"sudo {'-S' if sudo_password else '-n'} -p '' sh -c "
+        f"'while IFS= read -r line; do [ \"$line\" = {SCRIPT_START_MARKER} ] && break; done; exec bash -s'"
+    )
+    with instrumentation.events.span('script') as event:
+        try:
+            stdin, stdout, stderr = ssh_client.exec_command(command)
+            password_line = f"{sudo_password}\n" if sudo_password else ""
+            payload = f"{password_line}{SCRIPT_START_MARKER}\n{script}"
+            stdin.write(payload)
+            stdin.flush()
+            stdin.channel.shutdown_write()
+            output = stdout.read().decode()
+            error = stderr.read().decode().strip()
+            exit_status = stdout.channel.recv_exit_status()
+            event['bytes'] = len(payload) + len(output) + len(error)
+            if exit_status != 0:
+                event['outcome'] = 'failed'
+        except Exception as e:
+            event['outcome'] = 'error'
+            log(f"Error executing script: {e}")
+            return False, [{'step': 'connect', 'exit_status': None, 'output': str(e)}]
+    
+    steps = parse_script_steps(output)
+    if exit_status != 0:
+        if not steps or steps[-1]['exit_status'] == 0:
+            # Скрипт не дошёл до шагов - скорее всего не сработал sudo
+            steps.append({'step': 'sudo', 'exit_status': exit_status, 'output': error})
+        return False, steps
+    return True, steps
+
+HOST_KEY_POLICIES = ('accept-new', 'strict', 'warn', 'off')
+
+def key_fingerprint(key):
+    """OpenSSH-style SHA256 fingerprint of a host key."""
+    digest = hashlib.sha256(key.asbytes()).digest()
+    return "SHA256:" + base64.b64encode(digest).decode().rstrip('=')
+
+class UnknownHostKey(paramiko.SSHException):
+    """Raised for a host whose key is not cached under the 'strict' policy; never retried."""
+
+class HostKeyCache:
+    """known_hosts-format host key cache, indexed by host name.
+    
+    paramiko's HostKeys looks entries up with a linear scan, so instead the
+    file is parsed once into a dict and each connection is given only its
+    own host's keys. policy decides what happens on first contact and on a
+    key change: 'accept-new' records unknown keys and rejects changed ones,
+    'strict' rejects unknown keys too, 'warn' accepts and records changed
+    keys with a warning. Changes are kept in changes for the run's report.
+    """
+    
+    def __init__(self, path, policy='accept-new'):
+        self.path = os.path.expanduser(path)
+        self.policy = policy
+        self.entries = {}
+        self.changes = []
+        self.dirty = False
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    fields = line.split()
+                    # Хэшированные имена и @-маркеры в кэше не используются
+                    if len(fields) < 3 or fields[0].startswith(('#', '|', '@')):
+                        continue
+                    for name in fields[0].split(','):
+                        self.entries.setdefault(name, {})[fields[1]] = fields[2]
+        except FileNotFoundError:
+            pass
+    
+    @staticmethod
+    def host_name(hostname, port=22):
+        return hostname if port == 22 else f"[{hostname}]:{port}"
+    
+    def lookup(self, name):
+        """Return {key type: base64 key} known for name."""
+        with self.lock:
+            return dict(self.entries.get(name, {}))
+    
+    def configure(self, client, hostname, port=22):
+        """Preload client with the cached keys of hostname and install the cache's policy."""
+        name = self.host_name(hostname, port)
+        if self.policy != 'warn':
+            # С известным ключом paramiko сам договаривается о его типе и сверяет его
+            for key_type, key_base64 in self.lookup(name).items():
+                try:
+                    key = paramiko.PKey.from_type_string(key_type, base64.b64decode(key_base64))
+                except (ValueError, paramiko.SSHException):
+                    continue
+                client.get_host_keys().add(name, key_type, key)
+        client.set_missing_host_key_policy(HostKeyCachePolicy(self))
+    
+    def check(self, name, key, enroll=False):
+        """Apply the policy to key presented by name; returns 'new', 'known' or 'changed', or raises.
+        
+        enroll records unknown keys even under the 'strict' policy (explicit collection).
+        """
+        key_type, key_base64 = key.get_name(), key.get_base64()
+        with self.lock:
+            known = self.entries.get(name, {})
+            if known.get(key_type) == key_base64:
+                return 'known'
+            if not known:
+                if self.policy == 'strict' and not enroll:
+                    raise UnknownHostKey(f"Host key for {name} is not in {self.path} (strict host key policy)")
+                self.entries[name] = {key_type: key_base64}
+                self.dirty = True
+                return 'new'
+            old_base64 = known.get(key_type) or next(iter(known.values()))
+            old_type = key_type if key_type in known else next(iter(known))
+            old_key = paramiko.PKey.from_type_string(old_type, base64.b64decode(old_base64))
+            self.changes.append({
+                'host': name,
+                'old': f"{old_type} {key_fingerprint(old_key)}",
+                'new': f"{key_type} {key_fingerprint(key)}",
+                'accepted': self.policy == 'warn',
+            })
+            if self.policy != 'warn':
+                raise paramiko.BadHostKeyException(name, key, old_key)
+            self.entries[name] = {key_type: key_base64}
+            self.dirty = True
+        log(f"WARNING: host key of {name} changed ({key_fingerprint(old_key)} -> {key_fingerprint(key)}), accepted by policy")
+        return 'changed'
+    
+    def save(self):
+        """Atomically rewrite the cache, one sorted line per host and key type."""
+        with self.lock:
+            if not self.dirty:
+                return
+            lines = [
+                f"{name} {key_type} {key_base64}\n"
+                for name in sorted(self.entries)
+                for key_type, key_base64 in sorted(self.entries[name].items())
+            ]
+            self.dirty = False
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(lines)
+        os.replace(tmp_path, self.path)
+
+class HostKeyCachePolicy(paramiko.MissingHostKeyPolicy):
+    """paramiko policy that defers to a HostKeyCache for keys the client wasn't preloaded with."""
+    
+    def __init__(self, cache):
+        self.cache = cache
+    
+    def missing_host_key(self, client, hostname, key):
+        self.cache.check(hostname, key)
+
+def new_ssh_client(host_keys=None, hostname=None, port=22):
+    """Create an SSHClient checking host keys against host_keys (a HostKeyCache), or accepting any key without one."""
+    client = paramiko.SSHClient()
+    if host_keys:
+        host_keys.configure(client, hostname, port)
+    else:
+        client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    return client
+
+def connect_ssh(target_ip, args, ssh_password, jump_hosts=None, credential=None, host_keys=None):
+    """Open an authenticated admin SSH connection to the target host.
+    
+    With jump_hosts (a JumpHostPool) the session is tunnelled through a
+    direct-tcpip channel on the bastion instead of a direct TCP connection.
+    A credential (see Credential) overrides --ssh-user/--ssh-key. Host keys
+    are checked against host_keys (a HostKeyCache) if given.
+    """
+    ssh_user, ssh_key = args.ssh_user, args.ssh_key
+    if credential:
+        ssh_user, ssh_key = credential.user, credential.key
+    ssh_client = new_ssh_client(host_keys, target_ip, args.ssh_port)
+    
+    # Connect to remote host (TCP, handshake and authentication are timed together)
+    with instrumentation.events.span('connect', stage='connect'):
+        sock = jump_hosts.open_channel(target_ip, args.ssh_port) if jump_hosts else None
+        if ssh_key:
+            ssh_client.connect(
+                hostname=target_ip,
+                username=ssh_user,
+                key_filename=ssh_key,
+                password=ssh_password,
+                port=args.ssh_port,
+                sock=sock
+            )
+        else:
+            ssh_client.connect(
+                hostname=target_ip,
+                username=ssh_user,
+                password=ssh_password,
+                port=args.ssh_port,
+                sock=sock
+            )
+    return ssh_client
+
+def parse_jump_host(spec, default_user):
+    """Split a [user@]host[:port] jump host spec into (user, host, port)."""
+    user, _, host = spec.rpartition('@')
+    host, _, port = host.partition(':')
+    return user or default_user, host, int(port) if port else 22
+
+class JumpHostError(Exception):
+    """Raised when the bastion itself rejects authentication; never retried."""
+
+class JumpHostPool:
+    """A few authenticated transports to a bastion that carry every target session.
+    
+    Each target connection is a direct-tcpip channel on one of the pooled
+    transports (round robin), so a fleet run pays the bastion handshake once
+    per pooled connection instead of once per host. Dead transports are
+    reopened on demand.
+    """
+    
+    def __init__(self, spec, default_user, key_filename=None, password=None, size=1, channel_timeout=30,
+                 host_keys=None):
+        self.user, self.host, self.port = parse_jump_host(spec, default_user)
+        self.host_keys = host_keys
+        self.key_filename = key_filename
+        self.password = password
+        self.channel_timeout = channel_timeout
+        self.clients = [None] * max(1, size)
+        self.locks = [threading.Lock() for _ in self.clients]
+        self.counter = 0
+        self.counter_lock = threading.Lock()
+        self.auth_error = None
+    
+    def _transport(self, index):
+        with self.locks[index]:
+            client = self.clients[index]
+            if self.auth_error:
+                raise JumpHostError(self.auth_error)
+            if client is None or not client.get_transport() or not client.get_transport().is_active():
+                if client:
+                    client.close()
+                log(f"Connecting to jump host {self.user}@{self.host}:{self.port}...")
+                client = new_ssh_client(self.host_keys, self.host, self.port)
+                try:
+                    with instrumentation.events.span('connect', stage='jump_host', host=self.host):
+                        client.connect(
+                            hostname=self.host,
+                            port=self.port,
+                            username=self.user,
+                            key_filename=self.key_filename,
+                            password=self.password,
+                        )
+                except paramiko.AuthenticationException as e:
+                    # Повторные попытки на бастион только заблокируют учётную запись
+                    self.auth_error = f"Jump host {self.host} rejected authentication: {e}"
+                    raise JumpHostError(self.auth_error)
+                # Keepalive не даёт бастиону закрыть простаивающий транспорт
+                client.get_transport().set_keepalive(30)
+                self.clients[index] = client
+            return client.get_transport()
+    
+    def open_channel(self, target_ip, port):
+        """Open a direct-tcpip channel to target_ip:port through the bastion."""
+        with self.counter_lock:
+            index = self.counter % len(self.clients)
+            self.counter += 1
+        transport = self._transport(index)
+        return transport.open_channel('direct-tcpip', (target_ip, port), ('127.0.0.1', 0),
+                                      timeout=self.channel_timeout)
+    
+    def close(self):
+        for index, client in enumerate(self.clients):
+            if client:
+                client.close()
+                self.clients[index] = None
+
+class RateLimiter:
+    """Space out events to at most rate per second across all threads (0 = unlimited)."""
+    
+    def __init__(self, rate=0):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+    
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+class AdaptiveLimiter:
+    """AIMD concurrency limit driven by observed connect latency and failures.
+    
+    Starts at min_limit and grows by one per successful connection (slow
+    start) until the first sign of congestion, then by 1/limit per success.
+    A failure, or a connect slower than latency_tolerance times the fastest
+    one seen, cuts the limit by a third; connections started before the
+    last cut don't cut it again.
+    """
+    
+    def __init__(self, max_limit, min_limit=1, latency_tolerance=3.0, enabled=True):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(self.min_limit if enabled else self.max_limit)
+        self.enabled = enabled
+        self.latency_tolerance = latency_tolerance
+        self.slow_start = True
+        self.baseline = None
+        self.last_decrease = 0.0
+        self.in_flight = 0
+        self.condition = threading.Condition()
+    
+    @contextlib.contextmanager
+    def slot(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+    
+    def observe(self, started, latency=None, failed=False):
+        """Feed back one connection attempt that began at monotonic time started."""
+        if not self.enabled:
+            return
+        with self.condition:
+            if latency is not None:
+                self.baseline = latency if self.baseline is None else min(self.baseline, latency)
+            congested = failed or (
+                latency is not None and latency > self.latency_tolerance * self.baseline + 0.05
+            )
+            if congested:
+                if started >= self.last_decrease:
+                    self.limit = max(self.min_limit, self.limit * 2 / 3)
+                    self.slow_start = False
+                    self.last_decrease = time.monotonic()
+            else:
+                self.limit = min(self.max_limit, self.limit + (1 if self.slow_start else 1 / self.limit))
+            self.condition.notify_all()
+
+class HostCircuitOpen(Exception):
+    """Raised instead of connecting once a host has failed authentication too often."""
+
+class AccountCircuitOpen(HostCircuitOpen):
+    """Raised instead of logging in as a user that has failed authentication too often in the run."""
+
+class ConnectionScheduler:
+    """Paces, retries and limits SSH logins for a run.
+    
+    Transient connect errors (banner timeouts, resets, MaxStartups drops)
+    are retried with exponential backoff and full jitter. Authentication
+    failures are deterministic and never retried; they are counted per host
+    over every credential tried, and after auth_failure_limit of them the
+    host's circuit opens so no further logins are attempted (AD lockout).
+    With user_failure_limit the same happens run-wide for an account. New
+    connections are capped at connect_rate per second for the whole run, and the number of hosts in progress follows an
+    AdaptiveLimiter between 1 and max_concurrency. Connections are tunnelled
+    through jump_hosts (a JumpHostPool) if given and host keys are checked
+    against host_keys (a HostKeyCache). credentials and credential_cache
+    feed connect_with_credentials().
+    """
+    
+    def __init__(self, max_concurrency=1, retries=3, base_delay=1.0, max_delay=30.0,
+                 auth_failure_limit=3, connect_rate=0, adaptive=False, jump_hosts=None,
+                 credentials=(), credential_cache=None, host_keys=None, user_failure_limit=0):
+        self.retries = max(0, retries)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.auth_failure_limit = max(1, auth_failure_limit)
+        self.user_failure_limit = max(0, user_failure_limit)
+        self.rate_limiter = RateLimiter(connect_rate)
+        self.concurrency = AdaptiveLimiter(max_concurrency, enabled=adaptive)
+        self.jump_hosts = jump_hosts
+        self.host_keys = host_keys
+        self.credentials = list(credentials)
+        self.credential_cache = credential_cache
+        self.auth_failures = {}
+        self.user_failures = {}
+        self.lock = threading.Lock()
+    
+    @classmethod
+    def from_args(cls, args):
+        host_keys = None
+        if args.host_key_policy != 'off' and not args.dry_run:
+            host_keys = HostKeyCache(args.known_hosts, args.host_key_policy)
+        jump_hosts = None
+        if args.jump_host and not args.dry_run:
+            jump_hosts = JumpHostPool(args.jump_host, args.ssh_user, args.jump_key, args.jump_password, args.jump_pool,
+                                      host_keys=host_keys)
+        credentials = load_credentials(args.credentials) if args.credentials else []
+        credential_cache = None
+        if args.credential_cache and not args.dry_run:
+            credential_cache = CredentialCache(args.credential_cache)
+        return cls(max_concurrency=args.workers, retries=args.retries, base_delay=args.retry_delay,
+                   max_delay=args.retry_max_delay, auth_failure_limit=args.auth_failure_limit,
+                   connect_rate=args.connect_rate, adaptive=args.adaptive_concurrency,
+                   jump_hosts=jump_hosts, credentials=credentials, credential_cache=credential_cache,
+                   host_keys=host_keys, user_failure_limit=args.user_auth_failure_limit)
+    
+    def close(self):
+        if self.jump_hosts:
+            self.jump_hosts.close()
+        self.save()
+    
+    def save(self):
+        """Write the credential and host key caches."""
+        if self.credential_cache:
+            try:
+                self.credential_cache.save()
+            except OSError as e:
+                log(f"Error saving credential cache: {e}")
+        if self.host_keys:
+            try:
+                self.host_keys.save()
+            except OSError as e:
+                log(f"Error saving host key cache: {e}")
+    
+    def slot(self):
+        """Context manager that holds one of the adaptive concurrency slots."""
+        return self.concurrency.slot()
+    
+    def backoff(self, attempt):
+        """Full-jitter exponential backoff delay before retry number attempt (1-based)."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+    
+    def connect(self, target_ip, connect, user=None):
+        """Call connect() (returning an SSH client) under rate limit, retries and the circuit breakers.
+        
+        Authentication failures are raised straight away - retrying the same
+        secret only brings the account closer to lockout - and counted per
+        host, whichever credential failed, and per user for the whole run.
+        """
+        attempt = 0
+        while True:
+            with self.lock:
+                if self.auth_failures.get(target_ip, 0) >= self.auth_failure_limit:
+                    raise HostCircuitOpen(
+                        f"Circuit open: {self.auth_failures[target_ip]} authentication failures, not trying further logins"
+                    )
+                if self.user_failure_limit and self.user_failures.get(user, 0) >= self.user_failure_limit:
+                    raise AccountCircuitOpen(
+                        f"Circuit open: {self.user_failures[user]} authentication failures of {user} in this run, "
+                        f"not logging in to further hosts"
+                    )
+            self.rate_limiter.wait()
+            started = time.monotonic()
+            try:
+                client = connect()
+            except paramiko.AuthenticationException:
+                # Отказ в аутентификации ничего не говорит о нагрузке на sshd
+                with self.lock:
+                    self.auth_failures[target_ip] = self.auth_failures.get(target_ip, 0) + 1
+                    self.user_failures[user] = self.user_failures.get(user, 0) + 1
+                raise
+            except (paramiko.BadHostKeyException, UnknownHostKey):
+                # Ключ хоста не изменится от повтора и о нагрузке ничего не говорит
+                raise
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                self.concurrency.observe(started, failed=True)
+                if attempt >= self.retries:
+                    raise
+                error = str(e) or type(e).__name__
+            else:
+                self.concurrency.observe(started, latency=time.monotonic() - started)
+                return client
+            attempt += 1
+            delay = self.backoff(attempt)
+            log(f"Connect to {target_ip} failed ({error}), retry {attempt} in {delay:.1f}s")
+            time.sleep(delay)
+
+class Credential:
+    """One SSH login to try: a user with a password and/or a private key."""
+    
+    def __init__(self, user, password=None, key=None, name=None):
+        self.user = user
+        self.password = password
+        self.key = os.path.expanduser(key) if key else None
+        # Имя идентифицирует учётные данные в кэше - сами секреты туда не пишутся
+        self.name = name or (f"{user}:key:{key}" if key else f"{user}:password")
+
+def load_credentials(path):
+    """Read a JSON list of {"user", "password" and/or "key", optional "name"} credentials.
+    
+    Names must be unique: the credential cache refers to them, so several
+    passwords of one user need explicit names that survive reordering.
+    """
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError(f"{path}: expected a JSON list of credentials")
+    credentials = []
+    names = {}
+    for index, entry in enumerate(entries, 1):
+        if not isinstance(entry, dict) or not entry.get('user'):
+            raise ValueError(f"{path}: credential {index} has no user")
+        credential = Credential(entry['user'], entry.get('password'), entry.get('key'), entry.get('name'))
+        if credential.name in names or credential.name == 'command-line':
+            raise ValueError(
+                f"{path}: credential {index} has the same name '{credential.name}' as "
+                f"{f'credential {names[credential.name]}' if credential.name in names else 'the command-line login'}; "
+                f"give each a unique \"name\""
+            )
+        names[credential.name] = index
+        credentials.append(credential)
+    return credentials
+
+class CredentialCache:
+    """Remembers which credential logged in to each host and /24 subnet.
+    
+    The file maps hosts to the name of their last working credential and
+    /24 subnets to per-credential success counts, so a repeat run tries the
+    right login first and rarely pays for a failed authentication.
+    """
+    
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        self.lock = threading.Lock()
+        self.hosts = {}
+        self.subnets = {}
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            self.hosts = data.get('hosts', {})
+            self.subnets = data.get('subnets', {})
+        except (OSError, ValueError, AttributeError):
+            pass
+    
+    @staticmethod
+    def subnet(host):
+        try:
+            return str(ipaddress.ip_network(f"{host}/24", strict=False))
+        except ValueError:
+            return None
+    
+    def order(self, host, credentials):
+        """Return credentials with the host's and then the subnet's known-good ones first."""
+        with self.lock:
+            preferred = [self.hosts.get(host)]
+            counts = self.subnets.get(self.subnet(host), {})
+            preferred.extend(sorted(counts, key=counts.get, reverse=True))
+        by_name = {credential.name: credential for credential in credentials}
+        ordered = []
+        for name in preferred:
+            if name in by_name and by_name[name] not in ordered:
+                ordered.append(by_name[name])
+        return ordered + [credential for credential in credentials if credential not in ordered]
+    
+    def record(self, host, credential):
+        with self.lock:
+            self.hosts[host] = credential.name
+            subnet = self.subnet(host)
+            if subnet:
+                counts = self.subnets.setdefault(subnet, {})
+                counts[credential.name] = counts.get(credential.name, 0) + 1
+    
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with self.lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'hosts': self.hosts, 'subnets': self.subnets}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+def connect_with_credentials(target_ip, args, ssh_password, scheduler=None):
+    """Log in to target_ip, trying each credential of the run in turn.
+    
+    The command-line login comes first, then the --credentials list, both
+    reordered by the credential cache; args.credential (set by a daemon job
+    naming one) is tried alone. Returns (ssh_client, credential).
+    """
+    primary = Credential(args.ssh_user, ssh_password, args.ssh_key, name='command-line')
+    if scheduler is None:
+        return connect_ssh(target_ip, args, ssh_password), primary
+    
+    if getattr(args, 'credential', None) is not None:
+        credentials = [args.credential]
+    else:
+        credentials = list(scheduler.credentials)
+        if not credentials or ssh_password or args.ssh_key:
+            credentials.insert(0, primary)
+    if scheduler.credential_cache:
+        credentials = scheduler.credential_cache.order(target_ip, credentials)
+    
+    last_error = None
+    for credential in credentials:
+        try:
+            # Неверный пароль не повторяем - сразу пробуем следующий вариант
+            ssh_client = scheduler.connect(
+                target_ip,
+                lambda: connect_ssh(target_ip, args, credential.password, scheduler.jump_hosts, credential,
+                                    scheduler.host_keys),
+                user=credential.user,
+            )
+        except (paramiko.AuthenticationException, AccountCircuitOpen) as e:
+            # Открытый контур хоста (HostCircuitOpen) прекращает перебор целиком
+            last_error = e
+            if len(credentials) > 1:
+                log(f"Credential '{credential.name}' rejected: {e}")
+            continue
+        if scheduler.credential_cache:
+            scheduler.credential_cache.record(target_ip, credential)
+        return ssh_client, credential
+    raise last_error
+
+def read_public_key(public_key_path):
+    """Return the public key text, or None (with a warning) if the file is missing."""
+    key_path = Path(public_key_path)
+    if not key_path.exists():
+        log(f"Warning: SSH key not found at {key_path}")
+        return None
+    return key_path.read_text().strip()
+
+def public_key_blob(public_key):
+    """Return the base64 key blob of an OpenSSH public key line (the part the fingerprint is taken over)."""
+    parts = public_key.split()
+    for index, part in enumerate(parts[:-1]):
+        if part.startswith(('ssh-', 'ecdsa-', 'sk-')):
+            return parts[index + 1]
+    return public_key.strip()
+
+def probe_script(public_key=None, sudoers_content=SUDOERS_CONTENT):
+    """Build the script that reports the provisioning state of a host as key=value lines."""
+    blob = public_key_blob(public_key) if public_key else ""
+    sudoers_content = sudoers_content.rstrip("\n")
+    body = (
+        "if id -u semaphore >/dev/null 2>&1; then echo user_exists=1; else echo user_exists=0; fi\n"
+        "case \"$(getent shadow semaphore | cut -d: -f2)\" in\n"
+        "    ''|'!'*|'*'*) echo password_set=0 ;;\n"
+        "    *) echo password_set=1 ;;\n"
+        "esac\n"
+        f"if [ -f {SUDOERS_FILE} ]; then\n"
+        f"    echo \"sudoers_mode=$(stat -c %a {SUDOERS_FILE})\"\n"
+        f"    echo \"sudoers_owner=$(stat -c %U:%G {SUDOERS_FILE})\"\n"
+        f"    expected=$(cat <<'{HEREDOC_DELIMITER}'\n"
+        f"{sudoers_content}\n"
+        f"{HEREDOC_DELIMITER}\n"
+        ")\n"
+        f"    if [ \"$(cat {SUDOERS_FILE})\" = \"$expected\" ]; then echo sudoers_content=1; else echo sudoers_content=0; fi\n"
+        "else\n"
+        "    echo sudoers_content=0\n"
+        "fi\n"
+        "home=$(getent passwd semaphore | cut -d: -f6)\n"
+        f"if [ -n \"{blob}\" ] && [ -n \"$home\" ] && grep -qF \"{blob}\" \"$home/.ssh/authorized_keys\" 2>/dev/null; then\n"
+        "    echo key_present=1\n"
+        "else\n"
+        "    echo key_present=0\n"
+        "fi"
+    )
+    return build_script([("probe", body)])
+
+def probe_remote_state(ssh_client, public_key=None, sudo_password=None):
+    """Inspect the host in a single round trip and return a state dict, or None on failure."""
+    success, steps = execute_ssh_script(ssh_client, probe_script(public_key), sudo_password)
+    if not success or not steps:
+        return None
+    state = {}
+    for line in steps[0]['output'].splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            state[key.strip()] = value.strip()
+    return state
+
+def missing_steps(state, public_key=None, reset_password=False):
+    """Return the set of PROVISION_STEPS that still have to be applied for a probed state."""
+    needed = set()
+    user_exists = state.get('user_exists') == '1'
+    if not user_exists:
+        needed.add('create_user')
+    if not user_exists or state.get('password_set') != '1' or reset_password:
+        needed.add('set_password')
+    if (state.get('sudoers_content') != '1' or state.get('sudoers_mode') != '440'
+            or state.get('sudoers_owner') != 'root:root'):
+        needed.add('sudoers')
+    if public_key and state.get('key_present') != '1':
+        needed.add('authorized_key')
+    return needed
+
+def install_authorized_key(ssh_client, public_key, sudo_password=None, dry_run=False):
+    """Add public_key to ~semaphore/.ssh/authorized_keys over an existing admin connection.
+    
+    Replaces the sshpass/ssh-copy-id round trip: no new SSH handshake as the
+    semaphore user is needed, and the key is only appended once.
+    """
+    script = build_script([authorized_key_step(public_key)])
+    success, steps = execute_ssh_script(ssh_client, script, sudo_password, dry_run)
+    output = steps[-1]['output'] if steps else ""
+    return success, output
+
+def provision_batched(ssh_client, args, ssh_password=None, public_key=None, only=None, on_step_done=None):
+    """Apply all (or only the listed) provisioning steps in one remote round trip."""
+    log("\nProvisioning in batched mode (single channel)...")
+    script = build_script(provision_steps(args.semaphore_password, SUDOERS_CONTENT, public_key, only))
+    success, steps = execute_ssh_script(ssh_client, script, ssh_password, args.dry_run)
+    for step in steps:
+        if step['exit_status'] == 0:
+            log(f"✓ {step['step']}")
+            if on_step_done:
+                on_step_done(step['step'])
+        else:
+            log(f"✗ {step['step']} (exit status {step['exit_status']})")
+            if step['output']:
+                log(step['output'])
+    if not success:
+        failed_step = steps[-1]['step'] if steps else 'unknown'
+        return False, f"Batched provisioning failed at step '{failed_step}'"
+    return True, "dry run completed" if args.dry_run else "setup completed"
+
+def provision_host(target_ip, args, ssh_password=None, completed=frozenset(), on_step_done=None, scheduler=None):
+    """Provision the semaphore user on a single host.
+    
+    Steps listed in completed are skipped; on_step_done(step) is called for
+    every step that is applied or found already in place. The connection is
+    made through scheduler (a ConnectionScheduler) if given. Returns a
+    (success, message) tuple instead of exiting.
+    """
+    # SSH client setup
+    ssh_client = None
+    if on_step_done is None:
+        on_step_done = lambda step: None
+    
+    try:
+        if not args.dry_run:
+            log(f"Connecting to {target_ip}...")
+            ssh_client, credential = connect_with_credentials(target_ip, args, ssh_password, scheduler)
+            # Для sudo нужен пароль именно того входа, который подошёл
+            ssh_password = credential.password
+            log(f"Connected successfully as {credential.user}!")
+            on_step_done('connect')
+        else:
+            log(f"[DRY RUN] Would connect to {target_ip} as {args.ssh_user}")
+            if args.jump_host:
+                log(f"[DRY RUN] Through jump host: {args.jump_host}")
+            if args.ssh_key:
+                log(f"[DRY RUN] Using SSH key: {args.ssh_key}")
+            else:
+                log("[DRY RUN] Using password authentication")
+        
+        public_key = read_public_key(args.public_key)
+        needed = set(PROVISION_STEPS) - set(completed)
+        if completed:
+            log(f"Resuming: skipping steps completed in a previous run: {', '.join(sorted(completed))}")
+        if args.probe and not args.dry_run:
+            log("\nProbing remote state...")
+            instrumentation.bind(stage='probe')
+            state = probe_remote_state(ssh_client, public_key, ssh_password)
+            if state is None:
+                log("Probe failed, applying all steps")
+            else:
+                in_place = needed - missing_steps(state, public_key, args.reset_password)
+                needed -= in_place
+                for step in PROVISION_STEPS:
+                    if step in in_place and (step != 'authorized_key' or public_key):
+                        log(f"✓ {step}: already in place")
+                        on_step_done(step)
+                if not needed:
+                    return True, "already provisioned"
+        
+        if args.batch:
+            instrumentation.bind(stage='batch')
+            return provision_batched(ssh_client, args, ssh_password, public_key, needed, on_step_done)
+        
+        # Step 2: Create semaphore user with password
+        log("\n1. Creating semaphore user...")
+        if args.dry_run:
+            log(f"[DRY RUN] Would create user 'semaphore' with password")
+            # Simulate user creation commands
+            success, output = execute_ssh_command(
+                ssh_client, 
+                f"sudo adduser --gecos '' --disabled-password semaphore", 
+                ssh_password, 
+                args.dry_run
+            )
+            success, output = execute_ssh_command(
+                ssh_client,
+                f"echo 'semaphore:{args.semaphore_password}' | sudo chpasswd",
+                ssh_password,
+                args.dry_run
+            )
+        else:
+            if 'create_user' in needed:
+                instrumentation.bind(stage='create_user')
+                # Create user without password initially
+                success, output = execute_ssh_command(
+                    ssh_client, 
+                    "sudo adduser --gecos '' --disabled-password semaphore", 
+                    ssh_password, 
+                    args.dry_run
+                )
+                if not success:
+                    return False, "Failed to create semaphore user"
+                on_step_done('create_user')
+            
+            if 'set_password' in needed:
+                instrumentation.bind(stage='set_password')
+                # Set password for the user - используем правильную команду с sudo -S
+                # Экранируем пароль для безопасной передачи
+                escaped_password = args.semaphore_password.replace("'", "'\"'\"'")
+                chpasswd_command = f"echo 'semaphore:{escaped_password}' | sudo -S chpasswd"
+                
+                success, output = execute_ssh_command(
+                    ssh_client,
+                    chpasswd_command,
+                    ssh_password,
+                    args.dry_run
+                )
+                if not success:
+                    log("Failed to set password for semaphore user")
+                    # Попробуем альтернативный метод
+                    log("Trying alternative method to set password...")
+                    
+                    # Альтернативный метод: используем sudo с опцией -S для chpasswd
+                    alternative_command = f"echo '{ssh_password}' | sudo -S sh -c \"echo 'semaphore:{escaped_password}' | chpasswd\""
+                    success, output = execute_ssh_command(
+                        ssh_client,
+                        alternative_command,
+                        None,  # Пароль уже в команде
+                        args.dry_run
+                    )
+                    
+                    if not success:
+                        return False, "Failed to set password for semaphore user (alternative method also failed)"
+                on_step_done('set_password')
+        
+        log("✓ Semaphore user created successfully with specified password")
+        
+        if 'sudoers' in needed:
+            # Step 3 & 4: Create sudoers file
+            log("\n2. Creating sudoers file...")
+            instrumentation.bind(stage='sudoers')
+            sudoers_content = SUDOERS_CONTENT
+            
+            if args.dry_run:
+                log(f"[DRY RUN] Would create file /etc/sudoers.d/semaphore with content:")
+                log(f"[DRY RUN] '{sudoers_content.strip()}'")
+            else:
+                # Create temporary file using pathlib
+                # Имя файла уникально для хоста, чтобы параллельные воркеры не мешали друг другу
+                temp_file = Path(f"/tmp/semaphore_sudoers_{target_ip}")
+                try:
+                    temp_file.write_text(sudoers_content)
+                except Exception as e:
+                    return False, f"Error creating temporary file: {e}"
+                
+                # Use SCP to transfer the file
+                try:
+                    scp = SCPClient(ssh_client.get_transport())
+                    transfer_success = scp_put_file(scp, str(temp_file), '/tmp/semaphore_sudoers', args.dry_run)
+                    scp.close()
+                    
+                    if transfer_success:
+                        # Move file to correct location
+                        success, output = execute_ssh_command(
+                            ssh_client, 
+                            "sudo mv /tmp/semaphore_sudoers /etc/sudoers.d/semaphore",
+                            ssh_password,
+                            args.dry_run
+                        )
+                        if not success:
+                            return False, "Failed to move sudoers file"
+                    else:
+                        # Alternative method using echo
+                        success, output = execute_ssh_command(
+                            ssh_client, 
+                            f"echo 'semaphore ALL=(ALL) NOPASSWD: ALL' | sudo tee /etc/sudoers.d/semaphore",
+                            ssh_password,
+                            args.dry_run
+                        )
+                        if not success:
+                            return False, "Failed to create sudoers file"
+                except Exception as e:
+                    return False, f"Error during file transfer: {e}"
+                finally:
+                    # Clean up local temp file using pathlib
+                    if temp_file.exists():
+                        temp_file.unlink()
+            
+            log("✓ Sudoers file created successfully")
+            
+            # Step 5: Set correct permissions
+            log("\n3. Setting file permissions...")
+            success, output = execute_ssh_command(ssh_client, "sudo chmod 440 /etc/sudoers.d/semaphore", 
+                                                ssh_password, args.dry_run)
+            if not success and not args.dry_run:
+                return False, "Failed to set permissions"
+
+            log("\n4. Setting file owner...")
+            success, output = execute_ssh_command(ssh_client, "sudo chown root:root /etc/sudoers.d/semaphore", 
+                                                ssh_password, args.dry_run)
+            if not success and not args.dry_run:
+                return False, "Failed to set owner"
+            log("✓ Permissions set successfully")
+            on_step_done('sudoers')
+        
+        # Step 6: Install SSH key over the already authenticated admin connection
+        log("\n5. Installing SSH key for semaphore user...")
+        if public_key is None:
+            log("Please generate SSH key first with: ssh-keygen -t ed25519 -f /var/ddx/semaphore_id")
+        elif 'authorized_key' in needed:
+            instrumentation.bind(stage='authorized_key')
+            success, output = install_authorized_key(ssh_client, public_key, ssh_password, args.dry_run)
+            if not success:
+                return False, f"Failed to install SSH key: {output}"
+            log("✓ SSH key installed successfully!")
+            on_step_done('authorized_key')
+        
+        return True, "dry run completed" if args.dry_run else "setup completed"
+        
+    except (HostCircuitOpen, JumpHostError) as e:
+        return False, str(e)
+    except paramiko.AuthenticationException:
+        return False, "Authentication failed. Please check your credentials."
+    except paramiko.SSHException as e:
+        return False, f"SSH connection failed: {e}"
+    except Exception as e:
+        return False, f"Unexpected error: {e}"
+    finally:
+        # Ensure SSH connection is closed
+        if ssh_client and not args.dry_run:
+            ssh_client.close()
+
+class RunJournal:
+    """Append-only, fsync'd JSON-lines journal of per-host, per-step outcomes.
+    
+    Each line is a compact record {"t": timestamp, "h": host, "s": step,
+    "ok": bool, "m": message}; the step "host" marks the end of a host's run
+    and "start" marks a fresh (non-resumed) attempt that discards earlier
+    progress. Replaying the file yields the state used by --resume. On open
+    the journal is compacted to one "state" record per host carrying its
+    completed steps, so it stays proportional to the fleet, not its history.
+    """
+    
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._hosts = {}
+        torn, records = self._load()
+        if records > len(self._hosts):
+            self._compact()
+            torn = False
+        self._file = open(path, 'a', encoding='utf-8')
+        if torn:
+            # Завершаем оборванную строку, чтобы новые записи не склеились с ней
+            self._file.write('\n')
+    
+    def _load(self):
+        """Replay the journal; return (ends with a torn line, number of lines)."""
+        try:
+            f = open(self.path, encoding='utf-8')
+        except FileNotFoundError:
+            return False, 0
+        line = ''
+        records = 0
+        with f:
+            for line in f:
+                records += 1
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Оборванная строка после аварийного завершения
+                    continue
+                self._apply(entry)
+        return bool(line) and not line.endswith('\n'), records
+    
+    def _compact(self):
+        """Atomically rewrite the journal as one state record per host."""
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for host, host_state in self._hosts.items():
+                entry = {'t': host_state['t'], 'h': host, 's': 'state', 'ok': host_state['done'],
+                         'steps': sorted(host_state['steps'])}
+                f.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+    
+    def _apply(self, entry):
+        host_state = self._hosts.setdefault(entry['h'], {'steps': set(), 'done': False, 't': None})
+        host_state['t'] = entry.get('t')
+        step = entry['s']
+        if step == 'start':
+            host_state['steps'].clear()
+            host_state['done'] = False
+        elif step == 'state':
+            host_state['steps'] = set(entry.get('steps', ()))
+            host_state['done'] = entry['ok']
+        elif step == 'host':
+            host_state['done'] = entry['ok']
+        elif entry['ok']:
+            host_state['steps'].add(step)
+    
+    def record(self, host, step, ok, message=None):
+        """Append one outcome and make sure it reached the disk."""
+        entry = {'t': round(time.time(), 3), 'h': host, 's': step, 'ok': ok}
+        if message:
+            entry['m'] = message
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._apply(entry)
+    
+    def is_done(self, host):
+        """Return True if the last recorded run of host finished successfully."""
+        with self._lock:
+            return self._hosts.get(host, {}).get('done', False)
+    
+    def completed_steps(self, host):
+        """Return the steps of host that succeeded since its last fresh start."""
+        with self._lock:
+            return set(self._hosts.get(host, {}).get('steps', ()))
+    
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+def setup_host(target_ip, args, ssh_password=None, journal=None, scheduler=None):
+    """Provision one host, recording per-step progress in the journal.
+    
+    Returns a (success, message) tuple instead of exiting, so the same
+    steps can be driven for one host from main() or for many hosts from
+    run_pipeline(). The whole host is timed as the 'host/total' event.
+    """
+    instrumentation.bind(host=target_ip, stage=None)
+    with instrumentation.events.span('total', stage='host') as event:
+        success, message = _setup_host(target_ip, args, ssh_password, journal, scheduler)
+        if not success:
+            event['outcome'] = 'failed'
+    return success, message
+
+def _setup_host(target_ip, args, ssh_password=None, journal=None, scheduler=None):
+    """Body of setup_host(): provision the host and journal the outcome."""
+    if journal is None or args.dry_run:
+        return provision_host(target_ip, args, ssh_password, scheduler=scheduler)
+    
+    completed = set()
+    if args.resume:
+        completed = journal.completed_steps(target_ip)
+    else:
+        journal.record(target_ip, 'start', True)
+    
+    done_now = set()
+    def on_step_done(step):
+        done_now.add(step)
+        journal.record(target_ip, step, True)
+    
+    success, message = provision_host(target_ip, args, ssh_password, completed, on_step_done, scheduler)
+    if not success:
+        if 'connect' not in done_now:
+            failed_step = 'connect'
+        else:
+            failed_step = next(
+                (step for step in PROVISION_STEPS if step not in completed and step not in done_now),
+                'unknown'
+            )
+        journal.record(target_ip, failed_step, False, message)
+    journal.record(target_ip, 'host', success, message)
+    return success, message
+
+def read_inventory(inventory_file, group='labrat'):
+    """Read host addresses from an INI inventory written by get_conf_inbody_inventory.py."""
+    hosts = []
+    current_group = None
+    with open(inventory_file, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith(('#', ';')):
+                continue
+            if line.startswith('[') and line.endswith(']'):
+                current_group = line[1:-1]
+                continue
+            if current_group == group and line not in hosts:
+                # Ansible допускает переменные после имени хоста - берём только адрес
+                hosts.append(line.split()[0])
+    return hosts
+
+async def _probe_ssh_port(host, port, timeout, semaphore):
+    """Probe one host's SSH port and read its banner."""
+    result = {'host': host, 'port': port, 'status': None, 'banner': None, 'latency_ms': None, 'error': None}
+    async with semaphore:
+        start = time.monotonic()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        except asyncio.TimeoutError:
+            result['status'] = 'timeout'
+            return result
+        except ConnectionRefusedError:
+            result['status'] = 'refused'
+            return result
+        except OSError as e:
+            result['status'] = 'error'
+            result['error'] = str(e)
+            return result
+        
+        try:
+            banner = await asyncio.wait_for(reader.readline(), timeout)
+            result['latency_ms'] = round((time.monotonic() - start) * 1000, 1)
+            result['banner'] = banner.decode(errors='replace').strip()
+            if result['banner'].startswith('SSH-'):
+                result['status'] = 'reachable'
+            else:
+                result['status'] = 'error'
+                result['error'] = 'unexpected banner'
+        except asyncio.TimeoutError:
+            # Порт открыт, но sshd не прислал баннер (например, упёрлись в MaxStartups)
+            result['status'] = 'timeout'
+            result['error'] = 'no SSH banner'
+        except OSError as e:
+            result['status'] = 'error'
+            result['error'] = str(e)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+    return result
+
+async def _scan_hosts(hosts, port, timeout, concurrency):
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    return await asyncio.gather(*(_probe_ssh_port(host, port, timeout, semaphore) for host in hosts))
+
+def scan_reachability(hosts, port=22, timeout=3.0, concurrency=256):
+    """Probe the SSH port of every host concurrently.
+    
+    Returns a list of dicts (in the order of hosts) with the status
+    'reachable', 'refused', 'timeout' or 'error', the SSH banner and the
+    time it took to receive it.
+    """
+    return asyncio.run(_scan_hosts(hosts, port, timeout, concurrency))
+
+def write_scan_report(scan_results, report_file):
+    """Write reachability scan results as a JSON report."""
+    summary = {}
+    for result in scan_results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+    report = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'summary': summary,
+        'hosts': scan_results,
+    }
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+def run_preflight(hosts, args):
+    """Run the pre-flight scan and return (reachable_hosts, failures).
+    
+    failures maps every skipped host to a (False, message) result so it can be
+    merged into the fleet summary.
+    """
+    log(f"Pre-flight: probing port {args.ssh_port} on {len(hosts)} hosts (timeout {args.preflight_timeout}s)...")
+    scan_results = scan_reachability(hosts, args.ssh_port, args.preflight_timeout, args.preflight_concurrency)
+    if args.preflight_report:
+        try:
+            write_scan_report(scan_results, args.preflight_report)
+            log(f"Pre-flight report written to {args.preflight_report}")
+        except OSError as e:
+            log(f"Error writing pre-flight report: {e}")
+    
+    reachable = []
+    failures = {}
+    for result in scan_results:
+        if result['status'] == 'reachable':
+            reachable.append(result['host'])
+        else:
+            reason = result['status'] + (f": {result['error']}" if result['error'] else "")
+            failures[result['host']] = (False, f"Skipped, SSH port not reachable ({reason})")
+    log(f"Pre-flight: {len(reachable)} reachable, {len(failures)} skipped")
+    return reachable, failures
+
+def _setup_host_worker(target_ip, args, ssh_password, journal, scheduler):
+    """Run setup_host() in a worker thread with host-prefixed output.
+    
+    The host waits for one of the scheduler's adaptive concurrency slots.
+    """
+    _log_context.prefix = target_ip
+    try:
+        with scheduler.slot():
+            return setup_host(target_ip, args, ssh_password, journal, scheduler)
+    finally:
+        _log_context.prefix = None
+
+def print_fleet_summary(hosts, results):
+    """Print a per-host success/failure summary in inventory order."""
+    log("\n" + "=" * 50)
+    log("FLEET SUMMARY")
+    log("=" * 50)
+    failed = 0
+    for host in hosts:
+        success, message = results[host]
+        if not success:
+            failed += 1
+        log(f"{'✓' if success else '✗'} {host}: {message}")
+    log("-" * 50)
+    log(f"Total: {len(hosts)}, succeeded: {len(hosts) - failed}, failed: {failed}")
+    return failed
+
+def run_pipeline(hosts, args, ssh_password=None, journal=None):
+    """Stream hosts through the resume check, pre-flight probe and provisioning workers.
+    
+    hosts may be any iterable, including a generator that is still fetching
+    the inventory: every host is probed and handed to a provisioning worker
+    as soon as it is yielded. Returns (hosts in arrival order, results), where
+    results maps each host to its (success, message) result.
+    """
+    order = []
+    seen = set()
+    results = {}
+    scan_results = []
+    provision_futures = []
+    lock = threading.Lock()
+    scheduler = ConnectionScheduler.from_args(args)
+    executor = ThreadPoolExecutor(max_workers=max(1, args.workers))
+    
+    def submit(host):
+        future = executor.submit(_setup_host_worker, host, args, ssh_password, journal, scheduler)
+        with lock:
+            provision_futures.append((host, future))
+    
+    loop = None
+    probe_futures = []
+    if args.preflight:
+        # Проверки доступности идут в отдельном потоке с event loop,
+        # пока основной поток продолжает получать хосты
+        loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+        loop_thread.start()
+        
+        async def make_semaphore():
+            return asyncio.Semaphore(max(1, args.preflight_concurrency))
+        semaphore = asyncio.run_coroutine_threadsafe(make_semaphore(), loop).result()
+        
+        async def probe_and_submit(host):
+            result = await _probe_ssh_port(host, args.ssh_port, args.preflight_timeout, semaphore)
+            with lock:
+                scan_results.append(result)
+            if result['status'] == 'reachable':
+                submit(host)
+            else:
+                reason = result['status'] + (f": {result['error']}" if result['error'] else "")
+                message = f"Skipped, SSH port not reachable ({reason})"
+                log(f"{host}: {message}")
+                with lock:
+                    results[host] = (False, message)
+    
+    try:
+        for host in hosts:
+            if host in seen:
+                continue
+            seen.add(host)
+            order.append(host)
+            if args.resume and journal and journal.is_done(host):
+                results[host] = (True, "already completed (journal)")
+                continue
+            if loop:
+                probe_futures.append(asyncio.run_coroutine_threadsafe(probe_and_submit(host), loop))
+            else:
+                submit(host)
+        
+        for future in probe_futures:
+            future.result()
+    finally:
+        if loop:
+            loop.call_soon_threadsafe(loop.stop)
+            loop_thread.join()
+            loop.close()
+        # Все хосты уже переданы воркерам - дожидаемся их завершения
+        executor.shutdown(wait=True)
+        scheduler.close()
+    
+    for host, future in provision_futures:
+        try:
+            results[host] = future.result()
+        except Exception as e:
+            results[host] = (False, f"Unexpected error: {e}")
+    
+    if args.preflight_report:
+        position = {host: index for index, host in enumerate(order)}
+        scan_results.sort(key=lambda result: position[result['host']])
+        try:
+            write_scan_report(scan_results, args.preflight_report)
+            log(f"Pre-flight report written to {args.preflight_report}")
+        except OSError as e:
+            log(f"Error writing pre-flight report: {e}")
+    return order, results
+
+def verify_host(target_ip, args, pkey, scheduler):
+    """Log in as the semaphore user with its private key and check passwordless sudo.
+    
+    Returns a report entry {'host', 'status' ('pass' or 'fail'), 'stage'
+    (where it failed: 'connect', 'auth' or 'sudo'), 'error', 'latency_ms'}.
+    """
+    instrumentation.bind(host=target_ip, stage='verify')
+    result = {'host': target_ip, 'status': 'fail', 'stage': 'connect', 'error': None, 'latency_ms': None}
+    start = time.monotonic()
+    ssh_client = None
+    
+    def connect():
+        client = new_ssh_client(scheduler.host_keys, target_ip, args.ssh_port)
+        with instrumentation.events.span('connect'):
+            sock = scheduler.jump_hosts.open_channel(target_ip, args.ssh_port) if scheduler.jump_hosts else None
+            # Только ключ semaphore: агент и ключи из ~/.ssh исказили бы проверку
+            client.connect(
+                hostname=target_ip,
+                port=args.ssh_port,
+                username=args.verify_user,
+                pkey=pkey,
+                allow_agent=False,
+                look_for_keys=False,
+                sock=sock
+            )
+        return client
+    
+    try:
+        ssh_client = scheduler.connect(target_ip, connect, user=args.verify_user)
+        result['stage'] = 'sudo'
+        with instrumentation.events.span('exec') as event:
+            stdin, stdout, stderr = ssh_client.exec_command('sudo -n true')
+            exit_status = stdout.channel.recv_exit_status()
+            if exit_status != 0:
+                event['outcome'] = 'failed'
+        if exit_status != 0:
+            result['error'] = stderr.read().decode().strip() or f"exit status {exit_status}"
+        else:
+            result['status'] = 'pass'
+            result['stage'] = None
+    except paramiko.AuthenticationException as e:
+        result['stage'] = 'auth'
+        result['error'] = str(e)
+    except Exception as e:
+        result['error'] = str(e) or type(e).__name__
+    finally:
+        if ssh_client:
+            ssh_client.close()
+    result['latency_ms'] = round((time.monotonic() - start) * 1000, 1)
+    return result
+
+def _verify_host_worker(target_ip, args, pkey, scheduler):
+    _log_context.prefix = target_ip
+    try:
+        with scheduler.slot():
+            result = verify_host(target_ip, args, pkey, scheduler)
+        if result['status'] == 'pass':
+            log("✓ key authentication and passwordless sudo OK")
+        else:
+            log(f"✗ {result['stage']} failed: {result['error']}")
+        return result
+    finally:
+        _log_context.prefix = None
+
+def run_verification(hosts, args):
+    """Verify key login and passwordless sudo of the semaphore user on all hosts concurrently.
+    
+    The private key is loaded once and shared by all workers; connections go
+    through a ConnectionScheduler (rate limit, retries, jump host). Returns
+    the report entries in the order of hosts.
+    """
+    pkey = paramiko.PKey.from_path(args.verify_key)
+    public_key = read_public_key(args.public_key)
+    if public_key and public_key_blob(public_key) != pkey.get_base64():
+        log(f"Warning: {args.verify_key} does not match {args.public_key}")
+    
+    scheduler = ConnectionScheduler.from_args(args)
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            futures = {executor.submit(_verify_host_worker, host, args, pkey, scheduler): host for host in hosts}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+    finally:
+        scheduler.close()
+    return [results[host] for host in hosts]
+
+def write_verify_report(verify_results, report_file, inventory_file=None, group='labrat'):
+    """Write the pass/fail report as JSON and, optionally, an INI inventory of the passing hosts."""
+    report = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'summary': {
+            'pass': sum(1 for result in verify_results if result['status'] == 'pass'),
+            'fail': sum(1 for result in verify_results if result['status'] != 'pass'),
+        },
+        'hosts': verify_results,
+    }
+    with open(report_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    if inventory_file:
+        # Инвентарь только из проверенных хостов - его можно сразу отдать Semaphore
+        with open(inventory_file, 'w', encoding='utf-8') as f:
+            f.write(f"[{group}]\n")
+            for result in verify_results:
+                if result['status'] == 'pass':
+                    f.write(f"{result['host']}\n")
+
+def run_verify_mode(hosts, args):
+    """Run the verification pass, write the reports and exit with the fleet status."""
+    open_event_log(args)
+    log(f"Verifying {args.verify_user} key login and sudo on {len(hosts)} hosts with {args.workers} workers...")
+    try:
+        verify_results = run_verification(hosts, args)
+    except (OSError, paramiko.SSHException) as e:
+        log(f"Error loading private key {args.verify_key}: {e}")
+        sys.exit(1)
+    try:
+        write_verify_report(verify_results, args.verify_report, args.verify_inventory, args.inventory_group)
+        log(f"Verification report written to {args.verify_report}")
+    except OSError as e:
+        log(f"Error writing verification report: {e}")
+    finish_run(args)
+    
+    results = {}
+    for result in verify_results:
+        if result['status'] == 'pass':
+            results[result['host']] = (True, f"verified in {result['latency_ms']} ms")
+        else:
+            results[result['host']] = (False, f"{result['stage']} failed: {result['error']}")
+    failed = print_fleet_summary(hosts, results)
+    sys.exit(1 if failed else 0)
+
+def collect_host_key(target_ip, args, scheduler):
+    """Fetch target_ip's host key with a bare handshake (no authentication) and record it in the cache.
+    
+    Returns a report entry {'host', 'status' ('new', 'known', 'changed' or
+    'error'), 'key_type', 'fingerprint', 'error'}.
+    """
+    host_keys = scheduler.host_keys
+    name = HostKeyCache.host_name(target_ip, args.ssh_port)
+    result = {'host': name, 'status': 'error', 'key_type': None, 'fingerprint': None, 'error': None}
+    
+    def handshake():
+        with instrumentation.events.span('handshake', stage='host_keys', host=target_ip):
+            if scheduler.jump_hosts:
+                sock = scheduler.jump_hosts.open_channel(target_ip, args.ssh_port)
+            else:
+                sock = socket.create_connection((target_ip, args.ssh_port), timeout=args.host_key_timeout)
+            transport = paramiko.Transport(sock)
+            try:
+                # Тип ключа, который уже есть в кэше, предлагаем первым
+                options = transport.get_security_options()
+                preferred = []
+                for key_type in host_keys.lookup(name):
+                    # Ключ ssh-rsa согласуется как rsa-sha2-*
+                    preferred.extend(['rsa-sha2-512', 'rsa-sha2-256', key_type] if key_type == 'ssh-rsa' else [key_type])
+                preferred = [key_type for key_type in preferred if key_type in options.key_types]
+                if preferred:
+                    options.key_types = preferred + [key_type for key_type in options.key_types if key_type not in preferred]
+                transport.start_client(timeout=args.host_key_timeout)
+                return transport.get_remote_server_key()
+            finally:
+                transport.close()
+    
+    try:
+        key = scheduler.connect(target_ip, handshake)
+        result['key_type'] = key.get_name()
+        result['fingerprint'] = key_fingerprint(key)
+        result['status'] = host_keys.check(name, key, enroll=True)
+    except paramiko.BadHostKeyException:
+        result['status'] = 'changed'
+        result['error'] = f"host key changed, not accepted by the '{host_keys.policy}' policy"
+    except Exception as e:
+        result['error'] = str(e) or type(e).__name__
+    return result
+
+def run_collect_mode(hosts, args):
+    """Collect the host keys of all hosts concurrently into the known_hosts cache and exit."""
+    if args.host_key_policy == 'off':
+        log("Error: --collect-host-keys needs a host key policy other than 'off'")
+        sys.exit(1)
+    log(f"Collecting host keys of {len(hosts)} hosts into {args.known_hosts} with {args.workers} workers...")
+    scheduler = ConnectionScheduler.from_args(args)
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            futures = {executor.submit(collect_host_key, host, args, scheduler): host for host in hosts}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+    finally:
+        scheduler.close()
+    collect_results = [results[host] for host in hosts]
+    
+    summary = {}
+    for result in collect_results:
+        summary[result['status']] = summary.get(result['status'], 0) + 1
+        if result['status'] == 'changed':
+            log(f"WARNING: {result['host']}: {result['error'] or 'host key changed'}")
+        elif result['status'] == 'error':
+            log(f"✗ {result['host']}: {result['error']}")
+    log(f"Host keys: {', '.join(f'{count} {status}' for status, count in sorted(summary.items()))}")
+    if args.host_key_report:
+        report = {
+            'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'summary': summary,
+            'hosts': collect_results,
+            'changes': scheduler.host_keys.changes,
+        }
+        try:
+            with open(args.host_key_report, 'w', encoding='utf-8') as f:
+                json.dump(report, f, indent=2, ensure_ascii=False)
+            log(f"Host key report written to {args.host_key_report}")
+        except OSError as e:
+            log(f"Error writing host key report: {e}")
+    finish_run(args)
+    sys.exit(1 if summary.get('error') or summary.get('changed') else 0)
+
+# Параметры, которые задание демона может задать для себя, и их типы в argparse
+JOB_OPTIONS = {
+    'ssh_user': str, 'ssh_password': str, 'ssh_key': str, 'ssh_port': int, 'semaphore_password': str,
+    'public_key': str, 'batch': bool, 'probe': bool, 'reset_password': bool, 'dry_run': bool,
+}
+
+class JobError(ValueError):
+    """A daemon job line that cannot be run."""
+
+def json_lines_writer(stream):
+    """Return a thread-safe write(record) that sends one JSON line per record to stream.
+    
+    Once the reader has gone away further records are dropped, so jobs
+    still finish (and are journaled) after a client disconnects.
+    """
+    lock = threading.Lock()
+    state = {'open': True}
+    
+    def write(record):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with lock:
+            if not state['open']:
+                return
+            try:
+                stream.write(line)
+                stream.flush()
+            except (OSError, ValueError):
+                state['open'] = False
+    return write
+
+class ProvisioningDaemon:
+    """Resident provisioning worker fed with JSON-lines jobs.
+    
+    The interpreter, paramiko and the ConnectionScheduler (jump host
+    transports, host key and credential caches) are set up once; each job
+    line {"id", "target", "credential", "options"} then runs on a warm
+    worker thread. credential names the one entry of --credentials to log
+    in with, so secrets need not be sent with the job, and options (typed
+    as in JSON: "batch": true, "ssh_port": 22) override the JOB_OPTIONS of
+    the daemon's command line. Log lines and the result of every job are
+    streamed back as JSON lines tagged with the job id.
+    """
+    
+    def __init__(self, args, journal=None):
+        self.args = args
+        self.journal = journal
+        self.scheduler = ConnectionScheduler.from_args(args)
+        self.credentials = {credential.name: credential for credential in self.scheduler.credentials}
+        self.executor = ThreadPoolExecutor(max_workers=max(1, args.workers))
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+    
+    def parse_job(self, job):
+        """Validate a decoded job; returns (target, per-job args) or raises JobError."""
+        target = job.get('target')
+        if not target or not isinstance(target, str):
+            raise JobError("job has no target")
+        options = job.get('options') or {}
+        if not isinstance(options, dict):
+            raise JobError("options must be a JSON object")
+        options = {name.replace('-', '_'): value for name, value in options.items()}
+        unknown = sorted(set(options) - set(JOB_OPTIONS))
+        if unknown:
+            raise JobError(f"unknown options: {', '.join(unknown)}")
+        for name, value in options.items():
+            expected = JOB_OPTIONS[name]
+            # bool - подкласс int, поэтому тип сравниваем точно; null сбрасывает строковый параметр
+            if type(value) is not expected and not (value is None and expected is str):
+                raise JobError(f"option {name} must be {expected.__name__}, not {type(value).__name__}")
+        
+        job_args = argparse.Namespace(**vars(self.args))
+        vars(job_args).update(options)
+        job_args.credential = None
+        if job.get('credential'):
+            job_args.credential = self.credentials.get(job['credential'])
+            if job_args.credential is None:
+                raise JobError(f"unknown credential '{job['credential']}'")
+        if not job_args.semaphore_password:
+            raise JobError("no semaphore_password in the job or on the daemon's command line")
+        if not (job_args.ssh_password or job_args.ssh_key or self.credentials or job_args.dry_run):
+            raise JobError("no SSH password, key or credential for the job")
+        return target, job_args
+    
+    def run_job(self, job_id, target, job_args, write):
+        """Provision target with its log lines sent to write() and finish with a result record."""
+        started = time.monotonic()
+        _log_context.sink = lambda message: write({'id': job_id, 'event': 'log', 'host': target, 'message': message.strip("\n")})
+        try:
+            if job_args.resume and self.journal and self.journal.is_done(target):
+                success, message = True, "already completed (journal)"
+            else:
+                with self.scheduler.slot():
+                    success, message = setup_host(target, job_args, job_args.ssh_password, self.journal, self.scheduler)
+        except Exception as e:
+            success, message = False, f"Unexpected error: {e}"
+        finally:
+            _log_context.sink = None
+        
+        # Демон живёт долго - кэши и метрики сохраняем после каждого задания
+        with self.lock:
+            self.scheduler.save()
+            if self.args.prometheus_textfile:
+                try:
+                    instrumentation.events.write_prometheus(self.args.prometheus_textfile, 'semaphore_setup')
+                except OSError as e:
+                    log(f"Error writing Prometheus textfile: {e}")
+        write({'id': job_id, 'event': 'result', 'host': target, 'success': success, 'message': message,
+               'duration': round(time.monotonic() - started, 3)})
+    
+    def serve_stream(self, lines, write):
+        """Run every job read from lines, sending its records to write(record).
+        
+        Jobs start as soon as their line is read; returns once the input has
+        ended and all of its jobs have finished.
+        """
+        futures = []
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError as e:
+                write({'id': None, 'event': 'result', 'success': False, 'message': f"invalid job: {e}"})
+                continue
+            if not isinstance(job, dict):
+                write({'id': None, 'event': 'result', 'success': False, 'message': "invalid job: expected a JSON object"})
+                continue
+            job_id = job.get('id')
+            if job_id is None:
+                job_id = next(self.job_ids)
+            try:
+                target, job_args = self.parse_job(job)
+            except JobError as e:
+                write({'id': job_id, 'event': 'result', 'host': job.get('target'), 'success': False,
+                       'message': f"invalid job: {e}"})
+                continue
+            write({'id': job_id, 'event': 'accepted', 'host': target})
+            futures.append(self.executor.submit(self.run_job, job_id, target, job_args, write))
+        for future in futures:
+            future.result()
+    
+    def serve_connection(self, connection):
+        with connection, connection.makefile('r', encoding='utf-8') as reader, \
+                connection.makefile('w', encoding='utf-8') as writer:
+            try:
+                self.serve_stream(reader, json_lines_writer(writer))
+            except (OSError, ValueError) as e:
+                log(f"Client connection failed: {e}")
+    
+    def serve_unix(self, path):
+        """Accept clients on a Unix socket at path until interrupted; each is served in its own thread."""
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+        except OSError:
+            # Сокет остался от завершившегося демона
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+        else:
+            raise OSError(f"{path} is in use by another daemon")
+        finally:
+            probe.close()
+        
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # В заданиях бывают пароли - сокет доступен только владельцу
+        umask = os.umask(0o177)
+        try:
+            server.bind(path)
+        finally:
+            os.umask(umask)
+        server.listen()
+        log(f"Listening for jobs on {path} with {self.args.workers} workers")
+        try:
+            while True:
+                connection, _ = server.accept()
+                threading.Thread(target=self.serve_connection, args=(connection,), daemon=True).start()
+        finally:
+            server.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+    
+    def close(self):
+        """Wait for running jobs, then close the scheduler."""
+        self.executor.shutdown(wait=True)
+        self.scheduler.close()
+
+def run_serve_mode(args):
+    """Run the provisioning daemon on --serve until its input ends or it is terminated, then exit."""
+    output = sys.stdout
+    if args.serve == '-':
+        # stdout занят результатами заданий - остальной вывод идёт в stderr
+        sys.stdout = sys.stderr
+    _, journal = prepare_run(args, None, prompt=False)
+    try:
+        daemon = ProvisioningDaemon(args, journal)
+    except (OSError, ValueError) as e:
+        log(f"Error starting daemon: {e}")
+        finish_run(args, journal)
+        sys.exit(1)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    
+    status = 0
+    try:
+        if args.serve == '-':
+            daemon.serve_stream(sys.stdin, json_lines_writer(output))
+        else:
+            daemon.serve_unix(args.serve)
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        log(f"Error serving jobs: {e}")
+        status = 1
+    finally:
+        log("Daemon stopping, waiting for running jobs...")
+        daemon.close()
+        finish_run(args, journal)
+    sys.exit(status)
+
+def add_provisioning_arguments(parser):
+    """Add the per-host provisioning options shared by this script and the pipeline."""
+    parser.add_argument('--workers', type=int, default=10, help='Maximum number of hosts provisioned concurrently in fleet mode (default: 10)')
+    parser.add_argument('--semaphore-password', help='Password for semaphore user (required unless --verify)')
+    parser.add_argument('--ssh-user', default='root', help='SSH username (default: root)')
+    parser.add_argument('--ssh-password', help='SSH password (will prompt if not provided)')
+    parser.add_argument('--ssh-key', help='Path to SSH private key')
+    parser.add_argument('--ssh-port', type=int, default=22, help='SSH port (default: 22)')
+    parser.add_argument('--public-key', default='/var/ddx/semaphore_id.pub', help='Public key to install for the semaphore user (default: /var/ddx/semaphore_id.pub)')
+    parser.add_argument('--batch', action='store_true', help='Run all provisioning steps as one script over a single SSH channel')
+    parser.add_argument('--preflight', action='store_true', help='Probe the SSH port of all hosts concurrently and provision only reachable ones')
+    parser.add_argument('--preflight-timeout', type=float, default=3.0, help='Connect and banner timeout of the pre-flight probe in seconds (default: 3)')
+    parser.add_argument('--preflight-concurrency', type=int, default=256, help='Maximum number of simultaneous pre-flight probes (default: 256)')
+    parser.add_argument('--preflight-report', help='Write the pre-flight scan results to this JSON file (implies --preflight)')
+    parser.add_argument('--no-probe', dest='probe', action='store_false', help='Apply every step without first probing which ones are already in place')
+    parser.add_argument('--reset-password', action='store_true', help='Set the semaphore password even if the user already has one')
+    parser.add_argument('--journal', default='semaphore_setup.journal', help='Append-only journal of per-host, per-step outcomes (default: semaphore_setup.journal)')
+    parser.add_argument('--resume', action='store_true', help='Skip hosts completed in the journal and continue partially provisioned ones at the failed step')
+    parser.add_argument('--retries', type=int, default=3, help='Retries of an SSH connection after a transient error (default: 3)')
+    parser.add_argument('--retry-delay', type=float, default=1.0, help='Base delay of the exponential, jittered retry backoff in seconds (default: 1)')
+    parser.add_argument('--retry-max-delay', type=float, default=30.0, help='Upper bound of a single retry delay in seconds (default: 30)')
+    parser.add_argument('--auth-failure-limit', type=int, default=3, help='Stop logging in to a host after this many authentication failures, counted over all credentials tried (default: 3)')
+    parser.add_argument('--user-auth-failure-limit', type=int, default=0, help='Stop logging in as a user anywhere after this many authentication failures across the run, e.g. for a shared AD account (default: 0, no limit)')
+    parser.add_argument('--connect-rate', type=float, default=0, help='Maximum new SSH connections per second across all workers (default: 0, unlimited)')
+    parser.add_argument('--adaptive-concurrency', action='store_true', help='Start with one host at a time and adapt up to --workers to connect latency and failures')
+    parser.add_argument('--credentials', help='JSON list of further logins to try in order, e.g. [{"user": "root", "key": "~/.ssh/lab"}, {"user": "administrator", "password": "..."}]; several logins of one user need distinct "name"s')
+    parser.add_argument('--credential-cache', default='~/.cache/ddx-scripts/ssh_credentials.json', help='File remembering the working login per host and /24 subnet (default: ~/.cache/ddx-scripts/ssh_credentials.json)')
+    parser.add_argument('--no-credential-cache', dest='credential_cache', action='store_const', const=None, help='Neither use nor update the credential cache')
+    parser.add_argument('--known-hosts', default='~/.cache/ddx-scripts/known_hosts', help='Host key cache in known_hosts format (default: ~/.cache/ddx-scripts/known_hosts)')
+    parser.add_argument('--host-key-policy', choices=HOST_KEY_POLICIES, default='accept-new', help="accept-new: record unknown keys, reject changed ones; strict: reject unknown keys too; warn: accept changed keys with a warning; off: accept any key without the cache (default: accept-new)")
+    parser.add_argument('--jump-host', help='Reach all targets through this bastion, [user@]host[:port]; sessions are tunnelled over its SSH transport')
+    parser.add_argument('--jump-key', help='Private key for the jump host (default: SSH agent and ~/.ssh keys)')
+    parser.add_argument('--jump-password', help='Password for the jump host')
+    parser.add_argument('--jump-pool', type=int, default=1, help='Number of SSH transports opened to the jump host (default: 1)')
+    parser.add_argument('--dry-run', action='store_true', help='Show what would be done without making any changes')
+    parser.add_argument('--event-log', help="Append a JSON-lines timing event per connect, command, SCP and script to this file ('-' for stderr)")
+    parser.add_argument('--timing-summary', action='store_true', help='Print per-step latency percentiles at the end of the run')
+    parser.add_argument('--prometheus-textfile', help='Write per-step timings to this file for the node_exporter textfile collector')
+
+def open_event_log(args):
+    """Start streaming timing events to --event-log, if given."""
+    if args.event_log:
+        try:
+            instrumentation.events.open(args.event_log)
+        except OSError as e:
+            log(f"Error opening event log: {e}")
+            sys.exit(1)
+
+def prepare_run(args, target, prompt=True):
+    """Announce dry-run mode, prompt for the SSH password if needed, open the journal and event log.
+    
+    Returns (ssh_password, journal); journal is None in dry-run mode.
+    """
+    if args.preflight_report:
+        args.preflight = True
+    if args.preflight and args.jump_host:
+        # Порты целевых хостов напрямую недоступны - проверять их нечем
+        log("Error: --preflight cannot be combined with --jump-host")
+        sys.exit(1)
+    
+    if args.dry_run:
+        log("=== DRY RUN MODE ===")
+        log("No changes will be made to the remote system or local system.")
+        log("=" * 50)
+    
+    if args.credentials:
+        try:
+            load_credentials(args.credentials)
+        except (OSError, ValueError) as e:
+            log(f"Error reading credentials: {e}")
+            sys.exit(1)
+    
+    # Get SSH password if not provided
+    ssh_password = args.ssh_password
+    if prompt and not ssh_password and not args.ssh_key and not args.credentials and not args.dry_run:
+        import getpass
+        ssh_password = getpass.getpass(f"Enter SSH password for {args.ssh_user}@{target}: ")
+    
+    journal = None
+    if not args.dry_run:
+        try:
+            journal = RunJournal(args.journal)
+        except OSError as e:
+            log(f"Error opening journal: {e}")
+            sys.exit(1)
+    open_event_log(args)
+    return ssh_password, journal
+
+def finish_run(args, journal=None):
+    """Close the journal and event log and emit the end-of-run timing report."""
+    if journal:
+        journal.close()
+    instrumentation.finish(args.timing_summary, args.prometheus_textfile, 'semaphore_setup')
+
+def main():
+    parser = argparse.ArgumentParser(description='Setup semaphore user on remote host')
+    parser.add_argument('target_ip', nargs='?', help='Target IP address to connect to')
+    parser.add_argument('--inventory', help='Provision every host of the [labrat] group in this inventory file (fleet mode)')
+    parser.add_argument('--inventory-group', default='labrat', help='Inventory group to provision in fleet mode (default: labrat)')
+    parser.add_argument('--collect-host-keys', action='store_true', help='Only fetch the host keys of all hosts concurrently into --known-hosts')
+    parser.add_argument('--host-key-timeout', type=float, default=10.0, help='Connect and handshake timeout of --collect-host-keys in seconds (default: 10)')
+    parser.add_argument('--host-key-report', help='JSON report of --collect-host-keys with fingerprints and key changes')
+    parser.add_argument('--verify', action='store_true', help='Only verify key login as the semaphore user and passwordless sudo on all hosts')
+    parser.add_argument('--verify-user', default='semaphore', help='User to verify (default: semaphore)')
+    parser.add_argument('--verify-key', help='Private key to verify with (default: --public-key without .pub)')
+    parser.add_argument('--verify-report', default='semaphore_verify.json', help='JSON pass/fail report of --verify (default: semaphore_verify.json)')
+    parser.add_argument('--verify-inventory', help='Also write an INI inventory of the hosts that passed --verify')
+    parser.add_argument('--serve', metavar='SOCKET', help="Stay resident and run JSON-lines provisioning jobs read from this Unix socket ('-' for stdin, results on stdout)")
+    add_provisioning_arguments(parser)
+    
+    args = parser.parse_args()
+    
+    if args.serve:
+        if args.target_ip or args.inventory:
+            parser.error('--serve reads its targets from jobs, not from target_ip or --inventory')
+        run_serve_mode(args)
+    
+    if bool(args.target_ip) == bool(args.inventory):
+        parser.error('specify either target_ip or --inventory')
+    if not (args.verify or args.collect_host_keys) and not args.semaphore_password:
+        parser.error('the following arguments are required: --semaphore-password')
+    
+    hosts = [args.target_ip]
+    if args.inventory:
+        try:
+            hosts = read_inventory(args.inventory, args.inventory_group)
+        except OSError as e:
+            log(f"Error reading inventory: {e}")
+            sys.exit(1)
+        if not hosts:
+            log(f"No hosts found in group [{args.inventory_group}] of {args.inventory}")
+            sys.exit(1)
+    
+    if args.collect_host_keys:
+        open_event_log(args)
+        run_collect_mode(hosts, args)
+    
+    if args.verify:
+        if not args.verify_key:
+            args.verify_key = args.public_key[:-len('.pub')] if args.public_key.endswith('.pub') else args.public_key
+        run_verify_mode(hosts, args)
+    
+    ssh_password, journal = prepare_run(args, args.target_ip or f"hosts in {args.inventory}")
+    
+    if args.inventory:
+        log(f"Provisioning {len(hosts)} hosts with {args.workers} workers...")
+        hosts, results = run_pipeline(hosts, args, ssh_password, journal)
+        finish_run(args, journal)
+        failed = print_fleet_summary(hosts, results)
+        sys.exit(1 if failed else 0)
+    
+    if args.resume and journal and journal.is_done(args.target_ip):
+        log(f"{args.target_ip} already completed according to {args.journal}, nothing to do")
+        sys.exit(0)
+    
+    if args.preflight:
+        reachable, failures = run_preflight([args.target_ip], args)
+        if not reachable:
+            log(failures[args.target_ip][1])
+            sys.exit(1)
+    
+    scheduler = ConnectionScheduler.from_args(args)
+    success, message = setup_host(args.target_ip, args, ssh_password, journal, scheduler)
+    scheduler.close()
+    finish_run(args, journal)
+    if not success:
+        log(message)
+        sys.exit(1)
+    
+    log("\n" + "=" * 50)
+    if args.dry_run:
+        log("DRY RUN COMPLETED SUCCESSFULLY!")
+        log("No changes were made to the system.")
+    else:
+        log("SETUP COMPLETED SUCCESSFULLY!")
+        log(f"You can now SSH to the remote host as semaphore user:")
+        log(f"  ssh semaphore@{args.target_ip}")
+        log(f"Password: {args.semaphore_password}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+"""Tests of the pure parsing and bookkeeping helpers (no network or SSH)."""
+
+import json
+
+import pytest
+
+import get_conf_inbody_inventory as inventory
+import semaphore_user_remote_setup as setup
+
+def ip(value):
+    return inventory.ip_to_int(value)
+
+def ips(ranges):
+    return [(inventory.int_to_ip(start), inventory.int_to_ip(end)) for start, end in ranges]
+
+@pytest.mark.parametrize('text, expected', [
+    ('10.0.0.5', [('10.0.0.5', '10.0.0.5')]),
+    ('10.1.2.0/24', [('10.1.2.1', '10.1.2.254')]),
+    ('10.1.2.0/30', [('10.1.2.1', '10.1.2.2')]),
+    ('10.1.2.0/31', [('10.1.2.0', '10.1.2.1')]),
+    ('10.1.2.7/32', [('10.1.2.7', '10.1.2.7')]),
+    # Адрес хоста с маской - один хост, а не вся подсеть
+    ('eth0 10.20.30.40/24', [('10.20.30.40', '10.20.30.40')]),
+    ('10.1.2.10-40', [('10.1.2.10', '10.1.2.40')]),
+    ('10.1.2.250-10.1.3.5', [('10.1.2.250', '10.1.3.5')]),
+    ('10.0.0.1, 10.0.0.3', [('10.0.0.1', '10.0.0.1'), ('10.0.0.3', '10.0.0.3')]),
+])
+def test_find_ip_ranges(text, expected):
+    assert ips(inventory.find_ip_ranges(text)) == expected
+
+@pytest.mark.parametrize('text', [
+    '256.1.1.1',
+    '10.0.0.1/33',
+    '10.1.2.40-10',
+    '10.1.2.10-300',
+    '1.2.3.4.5',
+    'version 10.0.0.1.2',
+])
+def test_find_ip_ranges_rejects_invalid(text):
+    assert inventory.find_ip_ranges(text) == []
+
+def test_oversized_range_is_dropped_with_warning(capsys):
+    assert inventory.find_ip_ranges('10.0.0.0/8') == []
+    assert '10.0.0.0/8' in capsys.readouterr().err
+
+def test_ipset_merges_overlapping_and_adjacent_ranges():
+    ip_set = inventory.IPSet([(ip('10.0.0.5'), ip('10.0.0.9')), (ip('10.0.0.1'), ip('10.0.0.4')),
+                              (ip('10.0.0.8'), ip('10.0.0.12'))])
+    assert ips(ip_set.ranges()) == [('10.0.0.1', '10.0.0.12')]
+    assert len(ip_set) == 12
+    assert '10.0.0.12' in ip_set and '10.0.0.13' not in ip_set
+    assert list(inventory.IPSet.from_specs(['10.0.0.3', '10.0.0.1-2'])) == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+
+def test_ipset_from_specs_rejects_garbage():
+    with pytest.raises(ValueError):
+        inventory.IPSet.from_specs(['not-an-address'])
+
+def test_ipset_intersection_and_difference():
+    ip_set = inventory.IPSet.from_specs(['10.0.0.0/24'])
+    other = inventory.IPSet.from_specs(['10.0.0.10-20', '10.0.0.100-10.0.1.50'])
+    assert ips(ip_set.intersection(other).ranges()) == [('10.0.0.10', '10.0.0.20'),
+                                                         ('10.0.0.100', '10.0.0.254')]
+    assert ips(ip_set.difference(other).ranges()) == [('10.0.0.1', '10.0.0.9'),
+                                                       ('10.0.0.21', '10.0.0.99')]
+    assert list(ip_set.difference(ip_set)) == []
+
+def test_ipset_clip():
+    ip_set = inventory.IPSet.from_specs(['10.0.0.5-10', '10.0.0.20-30', '10.0.0.40'])
+    assert ips(ip_set.clip(ip('10.0.0.8'), ip('10.0.0.25'))) == [('10.0.0.8', '10.0.0.10'),
+                                                                  ('10.0.0.20', '10.0.0.25')]
+    assert ip_set.clip(ip('10.0.0.11'), ip('10.0.0.19')) == []
+    assert ips(ip_set.clip(ip('10.0.0.40'), ip('10.0.0.40'))) == [('10.0.0.40', '10.0.0.40')]
+
+def test_table_parser_handles_headers_and_several_tables():
+    parser = inventory.TableParser()
+    parser.feed(
+        '<table><tbody><tr><th>Host</th><th>IP</th></tr>'
+        '<tr><td>alpha</td><td><p>10.0.0.1</p><p>10.0.0.2</p></td></tr>'
+        '<tr><td>beta</td><td>10.0.0.3</td></tr></tbody></table>'
+        '<p>text</p>'
+        '<table><tr><td>gamma</td><td>10.0.1.1<br/>note</td></tr></table>'
+    )
+    parser.close()
+    assert parser.tables == 2
+    assert parser.rows == [
+        {'table': 0, 'row': 0, 'headers': ['Host', 'IP'], 'cells': ['alpha', '10.0.0.1 10.0.0.2']},
+        {'table': 0, 'row': 1, 'headers': ['Host', 'IP'], 'cells': ['beta', '10.0.0.3']},
+        {'table': 1, 'row': 0, 'headers': [], 'cells': ['gamma', '10.0.1.1 note']},
+    ]
+
+def test_extract_host_records_keeps_intervals():
+    client = inventory.ConfluenceClient('http://confluence.invalid', 'user', 'password')
+    html = ('<table><tr><th>IP</th><th>Role</th></tr>'
+            '<tr><td>10.0.0.0/16</td><td>lab</td></tr></table>')
+    records = client.extract_host_records({'body': {'storage': {'value': html}}})
+    assert len(records) == 1
+    assert ips([(records[0]['start'], records[0]['end'])]) == [('10.0.0.1', '10.0.255.254')]
+    assert records[0]['vars'] == {'IP': '10.0.0.0/16', 'Role': 'lab'}
+    assert client.extract_host_records({'body': {'storage': {'value': '<p>no table</p>'}}}) is None
+
+def test_journal_replays_steps_and_resets_on_start(tmp_path):
+    path = tmp_path / 'run.journal'
+    journal = setup.RunJournal(str(path))
+    journal.record('10.0.0.1', 'start', True)
+    journal.record('10.0.0.1', 'connect', True)
+    journal.record('10.0.0.1', 'create_user', True)
+    journal.record('10.0.0.1', 'sudoers', False, 'boom')
+    journal.record('10.0.0.1', 'host', False, 'boom')
+    journal.record('10.0.0.2', 'start', True)
+    journal.record('10.0.0.2', 'host', True)
+    journal.close()
+    
+    journal = setup.RunJournal(str(path))
+    assert journal.completed_steps('10.0.0.1') == {'connect', 'create_user'}
+    assert not journal.is_done('10.0.0.1')
+    assert journal.is_done('10.0.0.2')
+    journal.record('10.0.0.1', 'start', True)
+    assert journal.completed_steps('10.0.0.1') == set()
+    journal.close()
+
+def test_journal_compacts_to_one_record_per_host(tmp_path):
+    path = tmp_path / 'run.journal'
+    journal = setup.RunJournal(str(path))
+    for step in ('start', 'connect', 'create_user', 'set_password', 'host'):
+        journal.record('10.0.0.1', step, True)
+    journal.record('10.0.0.2', 'start', True)
+    journal.record('10.0.0.2', 'connect', True)
+    journal.close()
+    
+    journal = setup.RunJournal(str(path))
+    journal.close()
+    entries = [json.loads(line) for line in path.read_text(encoding='utf-8').splitlines()]
+    assert [(entry['h'], entry['s']) for entry in entries] == [('10.0.0.1', 'state'), ('10.0.0.2', 'state')]
+    
+    journal = setup.RunJournal(str(path))
+    assert journal.is_done('10.0.0.1')
+    assert journal.completed_steps('10.0.0.1') == {'connect', 'create_user', 'set_password'}
+    assert journal.completed_steps('10.0.0.2') == {'connect'}
+    journal.close()
+
+def test_journal_skips_torn_line(tmp_path):
+    path = tmp_path / 'run.journal'
+    line = json.dumps({'t': 1, 'h': '10.0.0.1', 's': 'connect', 'ok': True})
+    path.write_text(line + '\n{"t": 2, "h": "10.0.0.1", "s": "crea', encoding='utf-8')
+    
+    journal = setup.RunJournal(str(path))
+    journal.record('10.0.0.1', 'sudoers', True)
+    journal.close()
+    assert setup.RunJournal(str(path)).completed_steps('10.0.0.1') == {'connect', 'sudoers'}
+
+def test_parse_script_steps():
+    output = (
+        "noise before the first step\n"
+        f"{setup.STEP_BEGIN_MARKER} create_user\n"
+        "useradd output\n"
+        f"{setup.STEP_END_MARKER} create_user 0\n"
+        f"{setup.STEP_BEGIN_MARKER} sudoers\n"
+        "visudo: parse error\n"
+        f"{setup.STEP_END_MARKER} sudoers 1\n"
+        f"{setup.STEP_BEGIN_MARKER} authorized_key\n"
+        "partial\n"
+    )
+    assert setup.parse_script_steps(output) == [
+        {'step': 'create_user', 'exit_status': 0, 'output': 'useradd output'},
+        {'step': 'sudoers', 'exit_status': 1, 'output': 'visudo: parse error'},
+        {'step': 'authorized_key', 'exit_status': None, 'output': 'partial'},
+    ]
+
+def test_missing_steps():
+    in_place = {'user_exists': '1', 'password_set': '1', 'sudoers_content': '1',
+                'sudoers_mode': '440', 'sudoers_owner': 'root:root', 'key_present': '1'}
+    assert setup.missing_steps(in_place, public_key='ssh-ed25519 AAAA') == set()
+    assert setup.missing_steps(in_place, reset_password=True) == {'set_password'}
+    assert setup.missing_steps({}, public_key='ssh-ed25519 AAAA') == set(setup.PROVISION_STEPS)
+    assert setup.missing_steps({}) == {'create_user', 'set_password', 'sudoers'}
+    assert setup.missing_steps(dict(in_place, sudoers_mode='644')) == {'sudoers'}